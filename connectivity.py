@@ -0,0 +1,60 @@
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+# How long a probe or upload result is trusted before probing again
+ONLINE_TTL = 300
+OFFLINE_TTL = 30
+
+# Timeout for the TCP connect probe
+PROBE_TIMEOUT = 2
+
+
+# Tracks whether the cloud host is reachable. The state comes from a cheap
+# TCP connect to the host itself and is cached for a TTL. Real uploads
+# refresh it through report_success and report_failure, so while syncing
+# works no probe traffic is sent at all.
+class ConnectivityMonitor:
+    def __init__(self, url, online_ttl=ONLINE_TTL, offline_ttl=OFFLINE_TTL, timeout=PROBE_TIMEOUT):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.online_ttl = online_ttl
+        self.offline_ttl = offline_ttl
+        self.timeout = timeout
+        self._online = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _set(self, online):
+        with self._lock:
+            if self._online is not None and online != self._online:
+                print("Cloud host reachable again." if online else "Cloud host unreachable.")
+            self._online = online
+            self._checked_at = time.monotonic()
+
+    def report_success(self):
+        self._set(True)
+
+    def report_failure(self):
+        self._set(False)
+
+    def probe(self):
+        try:
+            with socket.create_connection((self.host, self.port), timeout=self.timeout):
+                pass
+            online = True
+        except OSError:
+            online = False
+        self._set(online)
+        return online
+
+    # Cached state, probing only once the TTL for the current state expired
+    def is_online(self):
+        with self._lock:
+            online = self._online
+            age = time.monotonic() - self._checked_at
+        if online is not None and age < (self.online_ttl if online else self.offline_ttl):
+            return online
+        return self.probe()
@@ -0,0 +1,306 @@
+import queue
+import threading
+import time
+
+from control_rules import compile_rules, pid_settings, reactor_config
+from metrics import REGISTRY
+from settings_listener import SettingsListener
+from topics import CONTROL_TOPICS, DEFAULT_REACTOR, reactor_topic
+
+RELAY_TOPICS = ("cstr/in", "cstr/heater1", "cstr/heater2", "mtank/out", "mtank/in", "mtank-recycle")
+
+# Relay commands are retained, so a relay that reboots gets its state from
+# the broker as soon as it resubscribes, and sent at least once
+RELAY_QOS = 1
+
+# Seconds a relay has to report its state on <relay>/state before the
+# command is sent again, and how many times it is resent before giving up
+CONFIRM_TIMEOUT = 10
+CONFIRM_RETRIES = 3
+
+RELAY_PUBLISHES = REGISTRY.counter('relay_publishes_total', 'Relay commands published', ('topic',))
+EVALUATION_SECONDS = REGISTRY.histogram('control_evaluation_seconds', 'Time per control pass in seconds', ('reactor',))
+
+# Queued by stop() to end the engine thread
+_STOP = ("stop", None)
+
+
+# Owns the controller state of one reactor (sensor values, relay states,
+# temp settings and the ramp target) and is the only thing that changes it.
+# What to switch is decided by the rules compiled from the reactor config,
+# with the heaters either on fixed bands or on a PID loop (heater_mode).
+# Sensor readings, settings changes and scheduled jobs are all turned into
+# events on one queue and handled in order by a single worker thread, so the
+# MQTT network thread, the settings listener and the scheduler never race
+# each other. The settings listener runs on the engine's own database
+# connection. Relay commands are published retained with QoS 1 when they
+# change; relays that report their state back are resent any command they
+# do not confirm. clock gives the time in seconds for PWM cycles and
+# confirmation timeouts. In PID mode the heaters must also switch between
+# readings, at the PWM edges, so the owner submits a heater tick every
+# heater_tick_interval seconds (None in bands mode).
+#
+# With coalesce_window set, sensor readings arriving within that many
+# seconds of each other are applied together and followed by a single
+# control pass on the latest state (0 coalesces whatever is already queued).
+# None evaluates after every reading.
+class ControlEngine:
+    def __init__(self, client, config=None, db_config=None, on_ramp_reset=None, coalesce_window=None,
+                 reactor_id=DEFAULT_REACTOR, clock=time.monotonic):
+        self.client = client
+        self.clock = clock
+        self.reactor_id = reactor_id
+        self.config = reactor_config(config)
+        self._cstr_actions, self._mtank_actions = compile_rules(self.config)
+        self.heater_tick_interval = None
+        if self.config["heater_mode"] == "pid":
+            self.heater_tick_interval = max(pid_settings(self.config)["min_pulse"], 1)
+        self.on_ramp_reset = on_ramp_reset
+        self.coalesce_window = coalesce_window
+        self.evaluations = 0
+        self.evaluations_saved = 0
+        self.sensor_values = {topic: None for topic in CONTROL_TOPICS}
+        self.previous_states = {topic: None for topic in RELAY_TOPICS}
+        # Last state each relay reported, and commands still awaiting it as
+        # topic -> (sent at, resends so far)
+        self.confirmed_states = {topic: None for topic in RELAY_TOPICS}
+        self._unconfirmed = {}
+        self.republished = 0
+        # Relay state changes, and how far cstr-temp was from the heating
+        # setpoint at each control pass
+        self.switch_counts = {topic: 0 for topic in RELAY_TOPICS}
+        self._error_count = 0
+        self._error_abs_sum = 0.0
+        self._error_sq_sum = 0.0
+        self._error_max = 0.0
+        self.current_temp_settings = {
+            "set_temp": None,
+            "over_duration": None,
+            "temp_change": None
+        }
+        self.target_temp = None
+        self._events = queue.Queue()
+        self._thread = None
+        self.relay_topics = {topic: reactor_topic(reactor_id, topic) for topic in RELAY_TOPICS}
+        self.state_topics = {reactor_topic(reactor_id, f"{topic}/state"): topic for topic in RELAY_TOPICS}
+        self.settings_listener = SettingsListener(db_config, self.submit_settings, reactor_id) if db_config else None
+
+    # Thread-safe entry points; the work happens on the engine thread
+
+    def submit_sensor(self, topic, value):
+        self._events.put(("sensor", topic, value))
+
+    def submit_settings(self, new_settings):
+        self._events.put(("settings", new_settings))
+
+    def submit_ramp_step(self):
+        self._events.put(("ramp", None))
+
+    def submit_relay_state(self, topic, state):
+        self._events.put(("relay_state", topic, state))
+
+    def submit_confirm_check(self):
+        self._events.put(("confirm", None))
+
+    def submit_heater_tick(self):
+        self._events.put(("heater_tick", None))
+
+    # Apply one event synchronously on the calling thread
+    def handle(self, event):
+        kind, *args = event
+        if kind == "sensor":
+            topic, value = args
+            self.sensor_values[topic] = value
+            self.evaluate()
+        elif kind == "settings":
+            self.update_temp_settings(args[0])
+        elif kind == "ramp":
+            self.step_target_temp()
+        elif kind == "relay_state":
+            self.confirm_relay_state(*args)
+        elif kind == "confirm":
+            self.republish_unconfirmed()
+        elif kind == "heater_tick":
+            self.cstr_control(record_error=False)
+
+    def evaluate(self):
+        self.evaluations += 1
+        with EVALUATION_SECONDS.time(self.reactor_id):
+            self.cstr_control()
+            self.mtank_control()
+
+    # Wait up to the coalescing deadline for the next event
+    def _next_event(self, deadline):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return self._events.get_nowait()
+        return self._events.get(timeout=timeout)
+
+    # Apply a sensor reading plus any others that follow it within the
+    # coalescing window, then evaluate once. Returns the first event that is
+    # not a sensor reading, for the caller to handle next, or None.
+    def _handle_sensor_burst(self, event):
+        deadline = time.monotonic() + self.coalesce_window
+        self.sensor_values[event[1]] = event[2]
+        following = None
+        while True:
+            try:
+                following = self._next_event(deadline)
+            except queue.Empty:
+                following = None
+                break
+            if following[0] != "sensor":
+                break
+            self.sensor_values[following[1]] = following[2]
+            self.evaluations_saved += 1
+        self.evaluate()
+        return following
+
+    def _run(self):
+        event = self._events.get()
+        while event is not _STOP:
+            following = None
+            try:
+                if event[0] == "sensor" and self.coalesce_window is not None:
+                    following = self._handle_sensor_burst(event)
+                else:
+                    self.handle(event)
+            except Exception as e:
+                print(f"Error handling {event[0]} event: {e}")
+            event = following or self._events.get()
+
+    # Events waiting for the engine thread
+    def backlog(self):
+        return self._events.qsize()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='control-engine', daemon=True)
+        self._thread.start()
+        if self.settings_listener is not None:
+            self.settings_listener.start()
+
+    def stop(self):
+        if self.settings_listener is not None:
+            self.settings_listener.stop()
+        self._events.put(_STOP)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _reset_ramp(self):
+        if self.on_ramp_reset is not None:
+            self.on_ramp_reset()
+
+    # Function to apply temp settings pushed by the settings listener
+    def update_temp_settings(self, new_settings):
+        new_temp_settings = {
+            "set_temp": new_settings[0],
+            "over_duration": new_settings[1],
+            "temp_change": new_settings[2]
+        }
+        # Leave the heating ramp alone unless the settings actually changed
+        if new_temp_settings == self.current_temp_settings:
+            return
+        self.current_temp_settings = new_temp_settings
+        print(f"Applying new temp settings for {self.reactor_id}: {self.current_temp_settings}")
+
+        # Recalculate target_temp with new settings and restart the hourly ramp
+        if self.sensor_values["cstr-temp"] is not None:
+            self.target_temp = self.sensor_values["cstr-temp"] + self.current_temp_settings["temp_change"]
+            self._reset_ramp()
+
+        # Ensure control logic is applied with updated settings
+        self.evaluate()
+
+    def _send(self, topic, state):
+        self.client.publish(self.relay_topics[topic], state, qos=RELAY_QOS, retain=True)
+        RELAY_PUBLISHES.inc(self.relay_topics[topic])
+
+    # Function to publish MQTT messages only on state change
+    def publish_state(self, topic, state):
+        if self.previous_states[topic] != state:
+            self._send(topic, state)
+            if self.previous_states[topic] is not None:
+                self.switch_counts[topic] += 1
+            self.previous_states[topic] = state
+            # Only relays that have reported a state are expected to confirm
+            confirmed = self.confirmed_states[topic]
+            if confirmed is None or confirmed == state:
+                self._unconfirmed.pop(topic, None)
+            else:
+                self._unconfirmed[topic] = (self.clock(), 0)
+
+    # Hourly step of the heating ramp towards set_temp
+    def step_target_temp(self):
+        temp_change = self.current_temp_settings["temp_change"]
+        if temp_change is None or self.sensor_values["cstr-temp"] is None:
+            return
+        self.target_temp = self.sensor_values["cstr-temp"] + temp_change
+        print(f"{self.reactor_id} target temp: {self.target_temp}")
+        self.cstr_control()
+
+    # State reported back by a relay on <relay>/state. A relay that comes
+    # back in a different state than commanded is corrected straight away.
+    def confirm_relay_state(self, topic, state):
+        self.confirmed_states[topic] = state
+        commanded = self.previous_states[topic]
+        if commanded is None or state == commanded:
+            self._unconfirmed.pop(topic, None)
+        elif topic not in self._unconfirmed:
+            print(f"{self.relay_topics[topic]} reports {state}, expected {commanded}; resending")
+            self._send(topic, commanded)
+            self.republished += 1
+            self._unconfirmed[topic] = (self.clock(), 0)
+
+    # Resend commands that no relay state has confirmed within CONFIRM_TIMEOUT
+    def republish_unconfirmed(self):
+        now = self.clock()
+        for topic, (sent_at, resends) in list(self._unconfirmed.items()):
+            if now - sent_at < CONFIRM_TIMEOUT:
+                continue
+            if resends >= CONFIRM_RETRIES:
+                print(f"No state confirmation from {self.relay_topics[topic]} after {resends} resends")
+                del self._unconfirmed[topic]
+                continue
+            self._send(topic, self.previous_states[topic])
+            self.republished += 1
+            self._unconfirmed[topic] = (now, resends + 1)
+
+    def _apply(self, actions):
+        for topic, state in actions:
+            self.publish_state(topic, state)
+
+    # record_error is False for heater ticks, so the error metrics stay one
+    # sample per control pass
+    def cstr_control(self, record_error=True):
+        set_temp = self.current_temp_settings["set_temp"]
+        temp_change = self.current_temp_settings["temp_change"]
+
+        if set_temp is None or temp_change is None or self.sensor_values["cstr-temp"] is None:
+            return
+
+        if self.target_temp is None:
+            # Settings arrived before the first temperature reading
+            self.target_temp = self.sensor_values["cstr-temp"] + temp_change
+            self._reset_ramp()
+
+        if record_error:
+            error = min(self.target_temp, set_temp) - self.sensor_values["cstr-temp"]
+            self._error_count += 1
+            self._error_abs_sum += abs(error)
+            self._error_sq_sum += error * error
+            self._error_max = max(self._error_max, abs(error))
+
+        self._apply(self._cstr_actions(self.sensor_values, self.target_temp, set_temp, self.clock()))
+
+    def heater_metrics(self):
+        count = self._error_count
+        return {
+            'heater_mode': self.config["heater_mode"],
+            'switches': dict(self.switch_counts),
+            'mean_abs_temp_error': self._error_abs_sum / count if count else 0.0,
+            'rms_temp_error': (self._error_sq_sum / count) ** 0.5 if count else 0.0,
+            'max_abs_temp_error': self._error_max,
+        }
+
+    def mtank_control(self):
+        self._apply(self._mtank_actions(self.sensor_values))
@@ -0,0 +1,137 @@
+import json
+
+from heater_pid import HeaterPID
+
+# Control parameters of one CSTR / membrane tank pair. A reactor config
+# overrides any of these; everything the controller decides on comes from
+# here rather than from constants in the control code.
+REACTOR_DEFAULTS = {
+    "max_cstr_level": 24.50,      # cstr/in is never switched on at or above this level
+    "mtank_fill_level": 8000,     # Below this the membrane tank only fills
+    "mtank_high_level": 8200,     # Above this the membrane tank recycles
+    "recycle_temp_offset": 5,     # Recycle when mtank-temp falls this far below cstr-temp...
+    "hysteresis": 0.5,            # ...give or take this much
+    "ramp_interval": 3600,        # Seconds between target temp steps
+    # Heaters to run by how far the temperature is below the ramp target,
+    # checked from the largest margin down; below every band both are off
+    "heater_bands": [
+        {"above": 1.2, "heaters": ["on", "on"]},
+        {"above": 0, "heaters": ["on", "off"]},
+    ],
+    # Same, once the ramp has reached set_temp: one heater for fine control
+    "hold_bands": [
+        {"above": 0, "heaters": ["on", "off"]},
+    ],
+    # "bands" switches the heaters by the bands above; "pid" runs them by
+    # time-proportional PWM from a PID loop (see heater_pid.HeaterPID)
+    "heater_mode": "bands",
+    "pid": {
+        "kp": 0.8,              # Heater duty per degree below target
+        "ki": 0.002,            # ...per degree-second of accumulated error
+        "kd": 0.0,
+        "period": 300,          # Seconds per PWM cycle
+        "feedforward": 0.0,     # Constant duty added to the output
+        "min_pulse": 5,         # Shortest on or off time worth switching a relay for
+    },
+}
+
+
+# Merge a partial reactor config over the defaults
+def reactor_config(overrides=None):
+    config = dict(REACTOR_DEFAULTS)
+    config.update(overrides or {})
+    return config
+
+
+# Read reactor configs from a JSON object of {reactor_id: overrides}
+def load_reactor_configs(path):
+    with open(path) as f:
+        return {reactor_id: reactor_config(overrides) for reactor_id, overrides in json.load(f).items()}
+
+
+# PID settings of a reactor config, filled in from the defaults
+def pid_settings(config):
+    return dict(REACTOR_DEFAULTS["pid"], **config["pid"])
+
+
+def _compile_bands(bands):
+    return tuple(sorted(
+        ((float(band["above"]), band["heaters"][0], band["heaters"][1]) for band in bands),
+        reverse=True
+    ))
+
+
+# Turn a reactor config into evaluator functions with every threshold bound
+# as a local. Each evaluator returns the (relay topic, state) actions to
+# apply, in order.
+def compile_rules(config):
+    max_cstr_level = float(config["max_cstr_level"])
+    fill_level = float(config["mtank_fill_level"])
+    high_level = float(config["mtank_high_level"])
+    recycle_below = float(config["recycle_temp_offset"]) + float(config["hysteresis"])
+    no_recycle_below = float(config["recycle_temp_offset"]) - float(config["hysteresis"])
+    heater_bands = _compile_bands(config["heater_bands"])
+    hold_bands = _compile_bands(config["hold_bands"])
+    pid = None
+    if config["heater_mode"] == "pid":
+        pid = HeaterPID(**pid_settings(config))
+    elif config["heater_mode"] != "bands":
+        raise ValueError(f"Unknown heater_mode: {config['heater_mode']}")
+
+    def heaters_for(error, bands):
+        for above, heater1, heater2 in bands:
+            if error > above:
+                return [("cstr/heater1", heater1), ("cstr/heater2", heater2)]
+        return [("cstr/heater1", "off"), ("cstr/heater2", "off")]
+
+    # now is a time in seconds, used by the PID mode for its PWM cycle
+    def cstr_actions(values, target_temp, set_temp, now):
+        actions = []
+        cstr_level = values["cstr-level"]
+        if cstr_level is not None and cstr_level >= max_cstr_level:
+            actions.append(("cstr/in", "off"))
+        if pid is not None:
+            heater1, heater2 = pid.heater_states(min(target_temp, set_temp), values["cstr-temp"], now)
+            actions += [("cstr/heater1", heater1), ("cstr/heater2", heater2)]
+        elif target_temp >= set_temp:
+            # Ensure the temperature does not fall below the set temperature
+            actions += heaters_for(set_temp - values["cstr-temp"], hold_bands)
+        else:
+            actions += heaters_for(target_temp - values["cstr-temp"], heater_bands)
+        return actions
+
+    def mtank_actions(values):
+        actions = [("mtank/in", "on")]
+        mtank_level = values["mtank-level"]
+        if mtank_level is None:
+            return actions
+        cstr_level = values["cstr-level"]
+        cstr_can_fill = cstr_level is not None and cstr_level < max_cstr_level
+
+        recycle = None
+        if mtank_level > fill_level:
+            mtank_temp = values["mtank-temp"]
+            cstr_temp = values["cstr-temp"]
+            # Temperature decides first, with hysteresis against rapid switching
+            if mtank_temp is not None and cstr_temp is not None:
+                if mtank_temp <= cstr_temp - recycle_below:
+                    recycle = True
+                elif mtank_temp >= cstr_temp - no_recycle_below:
+                    recycle = False
+            if recycle is None:
+                recycle = mtank_level > high_level
+        else:
+            # Prioritize filling until the level reaches mtank_fill_level
+            recycle = False
+
+        if recycle:
+            actions += [("mtank-recycle", "Yes"), ("mtank/out", "on")]
+            if cstr_can_fill:
+                actions.append(("cstr/in", "off"))
+        else:
+            actions += [("mtank-recycle", "No"), ("mtank/out", "off")]
+            if cstr_can_fill:
+                actions.append(("cstr/in", "on"))
+        return actions
+
+    return cstr_actions, mtank_actions
@@ -1,12 +1,20 @@
 import paho.mqtt.client as mqtt
-import psycopg2
-import json
 import time
-from datetime import datetime, timedelta
-import requests
+from datetime import datetime
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import os
+from db_pool import ConnectionPool
+from ingest_buffer import IngestWriter, SENSOR_DATA_COLUMNS
+from spool import Spool
+from flux_engine import FluxEngine
+from supabase_sync import SyncEngine
+from rollup import RollupRefresher, ensure_rollup_tables
+from sync_worker import SyncWorker
+from connectivity import ConnectivityMonitor
+from topics import SENSOR_TOPICS, REACTORS, ROUTES, reactor_topic
+from schema import ensure_reactor_columns
+from metrics import REGISTRY
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,6 +28,9 @@ DATABASE_CONFIG = {
     'port': '5432'        # Default PostgreSQL port
 }
 
+# Shared pool of database connections reused across cycles
+db_pool = ConnectionPool(DATABASE_CONFIG)
+
 # Supabase configuration
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
@@ -27,26 +38,84 @@ SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 # Create Supabase client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Cached reachability of the Supabase host
+connectivity = ConnectivityMonitor(SUPABASE_URL)
+
 # MQTT configuration
 MQTT_BROKER = '192.168.18.19'
 MQTT_PORT = 1883
-MQTT_TOPICS = ['cstr-level', 'cstr-temp', 'cstr-ph', 'cstr-orp', 'cstr-ec', 'cstr-tds', 'mtank-level', 'mtank-temp', 'effluent-level', 'weight']
+MQTT_TOPICS = [reactor_topic(reactor_id, name) for reactor_id in REACTORS for name in SENSOR_TOPICS]
 FLUX_TOPIC = 'flux'
 
-# Global variables to store sensor data
-sensor_data = {
-    'cstr_temp': None,
-    'cstr_level': None,
-    'cstr_ph': None,
-    'cstr_orp': None,
-    'cstr_ec': None,
-    'cstr_tds': None,
-    'mtank_temp': None,
-    'mtank_level': None,
-    'effluent_level': None,
-    'timestamp': None,
-    'published': False,
-    'weight': None
+# Flux windows in minutes and the topic each one is published on, within
+# each reactor's namespace. The STORED_FLUX_WINDOW flux is also written to
+# the flux column of sensor_data.
+FLUX_WINDOWS = {
+    1: 'flux/1m',
+    10: FLUX_TOPIC,
+    60: 'flux/60m'
+}
+STORED_FLUX_WINDOW = 10
+
+# Ingestion flush policy: write buffered readings once either threshold is hit
+INGEST_BUFFER_CAPACITY = 10000   # Readings kept in memory while the database is unreachable
+INGEST_FLUSH_ROWS = 200          # Flush as soon as this many readings are waiting
+INGEST_FLUSH_INTERVAL = 30       # Seconds between flushes at low message rates
+
+# Whether the Supabase tables have a reactor_id column. Single-reactor
+# installs keep the original Supabase schema, which does not.
+SUPABASE_REACTOR_ID = len(REACTORS) > 1
+
+# Columns of each local table uploaded to Supabase
+SYNC_SENSOR_COLUMNS = (
+    'timestamp', 'cstr_temp', 'cstr_level', 'cstr_ph', 'cstr_orp', 'cstr_ec', 'cstr_tds',
+    'mtank_temp', 'mtank_level', 'effluent_level', 'flux', 'weight'
+) + (('reactor_id',) if SUPABASE_REACTOR_ID else ())
+SYNC_TEMP_COLUMNS = ('timestamp', 'set_temp', 'over_duration', 'temp_change') + (('reactor_id',) if SUPABASE_REACTOR_ID else ())
+
+# On-disk spool for readings that could not be written while the database was down
+SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensor_data.spool')
+
+# Interval between flux calculations in the main loop
+FLUX_INTERVAL = 30
+
+# Seconds after which a channel's last reading counts as stale and is no
+# longer used for the flux calculation
+STALE_AFTER = 120
+
+# Port of the /metrics and /metrics.json endpoint
+METRICS_PORT = 9101
+
+MQTT_MESSAGES = REGISTRY.counter('mqtt_messages_total', 'MQTT messages received', ('topic',))
+MQTT_CALLBACK_SECONDS = REGISTRY.histogram('mqtt_callback_seconds', 'Time spent in the MQTT message callback in seconds')
+MQTT_PUBLISHES = REGISTRY.counter('mqtt_publishes_total', 'MQTT messages published', ('topic',))
+
+# Latest effluent level of each reactor and when it arrived, as
+# (level, received); the input of the flux calculation
+effluent_levels = {reactor_id: (None, None) for reactor_id in REACTORS}
+
+# 1-minute, 1-hour and 1-day summaries of sensor_data for the historical views
+rollups = RollupRefresher(db_pool)
+
+# Function to add the reactor columns and rollup tables the writers need
+def migrate_database():
+    with db_pool.connection() as conn:
+        ensure_reactor_columns(conn)
+        ensure_rollup_tables(conn)
+
+# Buffered writer that stores every reading in sensor_data and has the
+# rollups catch up after each write. It runs the migration before its first
+# write, so a database that was down at startup still gets migrated.
+ingest_writer = IngestWriter(
+    db_pool, INGEST_BUFFER_CAPACITY, INGEST_FLUSH_ROWS, INGEST_FLUSH_INTERVAL,
+    spool=Spool(SPOOL_PATH, SENSOR_DATA_COLUMNS, codes={'reactor_id': list(REACTORS)}),
+    on_flush=rollups.request, prepare=migrate_database
+)
+
+# In-memory window of effluent levels per reactor used for the flux calculation
+flux_engines = {
+    reactor_id: FluxEngine({minutes: reactor_topic(reactor_id, topic) for minutes, topic in FLUX_WINDOWS.items()}, reactor_id)
+    for reactor_id in REACTORS
 }
 
 # Utility function to convert datetime to string
@@ -60,157 +129,107 @@ def on_connect(client, userdata, flags, rc):
         client.subscribe(topic)
 
 def on_message(client, userdata, msg):
-    global sensor_data
-    topic = msg.topic
-    payload = json.loads(msg.payload.decode())
-    sensor_data['timestamp'] = datetime.now()
-
-    if topic == 'cstr-temp':
-        sensor_data['cstr_temp'] = float(payload)
-    elif topic == 'cstr-level':
-        sensor_data['cstr_level'] = float(payload)
-    elif topic == 'cstr-ph':
-        sensor_data['cstr_ph'] = float(payload)
-    elif topic == 'cstr-ec':
-        sensor_data['cstr_ec'] = float(payload)
-    elif topic == 'cstr-orp':
-        sensor_data['cstr_orp'] = float(payload)
-    elif topic == 'cstr-tds':
-        sensor_data['cstr_tds'] = float(payload)
-    elif topic == 'mtank-temp':
-        sensor_data['mtank_temp'] = float(payload)
-    elif topic == 'mtank-level':
-        sensor_data['mtank_level'] = float(payload)
-    elif topic == 'effluent-level':
-        sensor_data['effluent_level'] = float(payload)
-    elif topic == 'weight':
-        sensor_data['weight'] = float(payload)
-
-# Function to calculate flux
-def calculate_flux(current_level, conn, mqtt_client):
+    MQTT_MESSAGES.inc(msg.topic)
+    with MQTT_CALLBACK_SECONDS.time():
+        handle_message(msg)
+
+def handle_message(msg):
+    route = ROUTES.get(msg.topic)
+    if route is None or not route[1].stored:
+        return
+    reactor_id, topic = route
+    try:
+        value = topic.decode(msg.payload)
+    except ValueError as e:
+        print(f"Ignoring reading on {msg.topic}: {e}")
+        return
+
+    now = datetime.now()
+    if topic.column == 'effluent_level':
+        effluent_levels[reactor_id] = (value, now)
+        flux_engines[reactor_id].add(now, value)
+
+    save_to_database(reactor_id, now, {topic.column: value})
+
+# Function to calculate a reactor's flux over every window and publish it
+def calculate_flux(reactor_id, current_level, mqtt_client):
     try:
-        cursor = conn.cursor()
-        one_minute_ago = datetime.now() - timedelta(minutes=10)
-        query = '''
-        SELECT effluent_level 
-        FROM sensor_data 
-        WHERE timestamp <= %s 
-        ORDER BY timestamp DESC 
-        LIMIT 1;
-        '''
-        cursor.execute(query, (one_minute_ago,))
-        result = cursor.fetchone()
-        cursor.close()
-        if result:
-            previous_level = result[0]
-            flux = current_level - previous_level
-        else:
-            flux = 0  # If no previous data is found, assume no change
-
-        flux = int(flux)  # Convert flux to an integer
-        mqtt_client.publish(FLUX_TOPIC, flux)
-        return flux
+        flux_engine = flux_engines[reactor_id]
+        fluxes = flux_engine.publish(current_level, mqtt_client)
+        for minutes in fluxes:
+            MQTT_PUBLISHES.inc(flux_engine.windows[minutes])
+        return fluxes[STORED_FLUX_WINDOW]
     except Exception as e:
         print(f"Error calculating flux: {e}")
         return 0
 
-
-# Function to save data to the PostgreSQL database
-def save_to_database(data, mqtt_client):
+# Function to migrate the database and seed the flux windows from recent
+# database history
+def prepare_database():
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        flux = calculate_flux(data['effluent_level'], conn, mqtt_client)
-        cursor = conn.cursor()
-        insert_query = '''
-        INSERT INTO sensor_data (timestamp, cstr_temp, cstr_level, cstr_ph, cstr_orp, cstr_ec, cstr_tds, mtank_temp, mtank_level, effluent_level, flux, published, weight)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        '''
-        cursor.execute(insert_query, (data['timestamp'], data['cstr_temp'], data['cstr_level'], data['cstr_ph'], data['cstr_orp'], data['cstr_ec'], data['cstr_tds'], data['mtank_temp'], data['mtank_level'], data['effluent_level'], flux, data['published'], data['weight']))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("Data saved to database.")
-        return True, flux
+        ingest_writer.ensure_prepared()
+        with db_pool.connection() as conn:
+            for reactor_id, flux_engine in flux_engines.items():
+                count = flux_engine.seed(conn)
+                print(f"Loaded {count} effluent level readings for {reactor_id} flux calculation.")
     except Exception as e:
-        print(f"Error saving data to database: {e}")
-        return False, None
+        print(f"Error preparing database: {e}")
 
-# Function to check internet connectivity
-def is_connected():
-    try:
-        requests.get('http://www.google.com', timeout=5)
-        return True
-    except requests.ConnectionError:
-        return False
+# Function to get a reactor's effluent level, or None if it has gone stale
+def fresh_effluent_level(reactor_id, now):
+    level, received = effluent_levels[reactor_id]
+    if received is None or (now - received).total_seconds() > STALE_AFTER:
+        return None
+    return level
+
+# Function to refresh, publish and store a reactor's flux
+def update_flux(reactor_id, mqtt_client):
+    now = datetime.now()
+    current_level = fresh_effluent_level(reactor_id, now)
+    flux = calculate_flux(reactor_id, current_level, mqtt_client)
+    # A stale effluent level gives a flux of 0, which is not worth storing
+    if current_level is not None:
+        save_to_database(reactor_id, now, {'flux': flux})
+    return flux
+
+# Function to queue readings for the PostgreSQL database as one row holding
+# only the channels in values; every other channel is NULL, so each row
+# records what was actually measured at its timestamp
+def save_to_database(reactor_id, timestamp, values):
+    row = dict.fromkeys(SENSOR_DATA_COLUMNS)
+    row.update(values, timestamp=timestamp, published=False, reactor_id=reactor_id)
+    ingest_writer.append(row[column] for column in SENSOR_DATA_COLUMNS)
+
+# Function to format a sensor_data row for Supabase
+def format_sensor_row(row):
+    formatted = {column: row[column] for column in SYNC_SENSOR_COLUMNS}
+    formatted['timestamp'] = datetime_to_str(row['timestamp'])
+    return formatted
+
+# Function to format a temp_setting row for Supabase
+def format_temp_row(row):
+    formatted = {column: row[column] for column in SYNC_TEMP_COLUMNS}
+    formatted['timestamp'] = datetime_to_str(row['timestamp'])
+    return formatted
 
 # Function to upload unpublished data to Supabase
 def upload_unpublished_data():
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        cursor = conn.cursor()
-        
-        # Fetch and upload unpublished sensor data
-        cursor.execute("SELECT * FROM sensor_data WHERE published = FALSE")
-        data = cursor.fetchall()
-        if data:
-            formatted_data = []
-            ids = []
-            for row in data:
-                ids.append(row[0])  # Assuming id is the first column
-                formatted_data.append({
-                    'timestamp': datetime_to_str(row[1]),
-                    'cstr_temp': row[2],
-                    'cstr_level': row[3],
-                    'cstr_ph': row[4],
-                    'cstr_orp': row[5],
-                    'cstr_ec': row[6],
-                    'cstr_tds': row[7],
-                    'mtank_temp': row[8],
-                    'mtank_level': row[9],
-                    'effluent_level': row[10],
-                    'flux': row[11],
-                    'weight': row[12]
-                })
-            response = upload_data_to_supabase(formatted_data)
-            if response and response.data:
-                update_published_status(ids)
-                print("Sensor data uploaded and marked as published successfully.")
-            else:
-                print("Error uploading sensor data to Supabase")
-
-        # Fetch and upload unpublished temp settings
-        cursor.execute("SELECT * FROM temp_setting WHERE published = FALSE")
-        temp_data = cursor.fetchall()
-        if temp_data:
-            formatted_temp_data = []
-            temp_ids = []
-            for row in temp_data:
-                temp_ids.append(row[0])  # Assuming id is the first column
-                formatted_temp_data.append({
-                    'timestamp': datetime_to_str(row[1]),
-                    'set_temp': row[2],
-                    'over_duration': row[3],
-                    'temp_change': row[4]
-                })
-            response = upload_data_to_supabase_temp(formatted_temp_data)
-            if response and response.data:
-                update_published_status_temp(temp_ids)
-                print("Temp setting data uploaded and marked as published successfully.")
-            else:
-                print("Error uploading temp setting data to Supabase")
-
-        cursor.close()
-        conn.close()
+        sensor_sync.run()
+        temp_sync.run()
+        return True
     except Exception as e:
         print(f"Error uploading unpublished data to Supabase: {e}")
+        return False
 
 # Function to upload sensor data to Supabase
 def upload_data_to_supabase(data):
     try:
         response = supabase.table('sensor_data').insert(data).execute()
+        connectivity.report_success()
         return response
     except Exception as e:
+        connectivity.report_failure()
         print(f"Error uploading data to Supabase: {e}")
         return None
 
@@ -218,38 +237,37 @@ def upload_data_to_supabase(data):
 def upload_data_to_supabase_temp(data):
     try:
         response = supabase.table('temp_setting').insert(data).execute()
+        connectivity.report_success()
         return response
     except Exception as e:
+        connectivity.report_failure()
         print(f"Error uploading temp setting data to Supabase: {e}")
         return None
 
-# Function to update published status in the PostgreSQL database
-def update_published_status(ids):
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        cursor = conn.cursor()
-        ids_tuple = tuple(ids)
-        update_query = "UPDATE sensor_data SET published = TRUE WHERE id IN %s"
-        cursor.execute(update_query, (ids_tuple,))
-        conn.commit()
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        print(f"Error updating published status: {e}")
+# Incremental sync of each local table to Supabase
+sensor_sync = SyncEngine(db_pool, 'sensor_data', SYNC_SENSOR_COLUMNS, format_sensor_row, upload_data_to_supabase)
+temp_sync = SyncEngine(db_pool, 'temp_setting', SYNC_TEMP_COLUMNS, format_temp_row, upload_data_to_supabase_temp)
 
-# Function to update published status for temp setting in the PostgreSQL database
-def update_published_status_temp(ids):
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        cursor = conn.cursor()
-        ids_tuple = tuple(ids)
-        update_query = "UPDATE temp_setting SET published = TRUE WHERE id IN %s"
-        cursor.execute(update_query, (ids_tuple,))
-        conn.commit()
-        cursor.close()
-        conn.close()
-    except Exception as e:
-        print(f"Error updating published status: {e}")
+# Background worker that runs the sync off the sampling loop
+sync_worker = SyncWorker(upload_unpublished_data, connectivity.is_online)
+
+# Gauges over the ingestion and sync state, read on every scrape
+REGISTRY.gauge('ingest_buffer_rows', 'Readings waiting in memory for the next flush', func=ingest_writer.pending)
+REGISTRY.gauge('ingest_spool_rows', 'Readings spooled to disk while the database was down', func=ingest_writer.spool.pending)
+REGISTRY.gauge('ingest_rows', 'Readings handled by the ingest writer since start', ('outcome',), func=lambda: {
+    ('written',): ingest_writer.written,
+    ('spooled',): ingest_writer.spooled,
+    ('dropped',): ingest_writer.dropped,
+})
+REGISTRY.gauge('rollup_rows', 'Readings folded into the rollup tables since start', func=lambda: rollups.rows)
+REGISTRY.gauge('sync_backlog_rows', 'Rows not yet uploaded to Supabase', ('table',), func=lambda: {
+    (sync.table,): sync.backlog() for sync in (sensor_sync, temp_sync)
+})
+REGISTRY.gauge('sync_worker', 'Sync worker state', ('field',), func=lambda: {
+    ('backoff_seconds',): sync_worker.backoff,
+    ('failures',): sync_worker.failures,
+    ('coalesced',): sync_worker.coalesced,
+})
 
 # Main loop to handle data processing
 def main_loop():
@@ -257,20 +275,35 @@ def main_loop():
     client.on_connect = on_connect
     client.on_message = on_message
 
+    prepare_database()
+    REGISTRY.serve(METRICS_PORT)
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    ingest_writer.start()
+    rollups.start()
+    sync_worker.start()
     client.loop_start()
 
-    while True:
-        time.sleep(30)  # Check every minute
+    # Schedule against the monotonic clock so time spent in a cycle does not
+    # push the following ones back
+    next_cycle = time.monotonic()
+    try:
+        while True:
+            next_cycle += FLUX_INTERVAL
+            time.sleep(max(0, next_cycle - time.monotonic()))
 
-        # Save data to local database
-        success, flux = save_to_database(sensor_data, client)
-        if success:
-            sensor_data['published'] = False
+            # Publish and store the latest flux; readings are saved as they arrive
+            for reactor_id in REACTORS:
+                update_flux(reactor_id, client)
 
-        # Check for internet connection and upload unpublished data
-        if is_connected():
-            upload_unpublished_data()
+            # Hand the upload to the sync worker, which checks connectivity
+            sync_worker.request()
+    finally:
+        client.loop_stop()
+        sync_worker.stop(timeout=5)
+        ingest_writer.stop()
+        rollups.stop()
+        db_pool.closeall()
+        REGISTRY.stop()
 
 if __name__ == '__main__':
     main_loop()
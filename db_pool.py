@@ -0,0 +1,139 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+
+from metrics import REGISTRY
+
+# Pool sizing for the Raspberry Pi: one each for the ingest writer, the
+# rollup refresher, the sync job and metrics scrapes, plus one spare, without
+# starving the dashboards. Callers beyond that wait for a free connection.
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 5
+
+# Seconds a caller waits for a free connection before giving up
+POOL_CHECKOUT_TIMEOUT = 30
+
+# Connections idle for longer than this are pinged before being handed out
+HEALTH_CHECK_INTERVAL = 30
+
+# Back off between attempts to rebuild the pool while the database is down
+RECONNECT_DELAY = 5
+
+# Latency of the statements callers time with DB_QUERY_SECONDS.time(query)
+DB_QUERY_SECONDS = REGISTRY.histogram('db_query_seconds', 'Database statement latency in seconds', ('query',))
+
+
+class ConnectionPool:
+    def __init__(self, config, minconn=POOL_MIN_CONNECTIONS, maxconn=POOL_MAX_CONNECTIONS):
+        self.config = config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._last_used = {}
+        self._last_reconnect_attempt = 0
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool raises rather than waits when every
+        # connection is out, so callers queue here first
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    # Build the underlying pool lazily so a database that is down at startup
+    # does not stop the caller from running
+    def _ensure_pool(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                return self._pool
+            now = time.monotonic()
+            if now - self._last_reconnect_attempt < RECONNECT_DELAY:
+                raise psycopg2.OperationalError("Database unavailable, waiting before reconnecting")
+            self._last_reconnect_attempt = now
+            self._pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.config)
+            self._last_used = {}
+            print("Database connection pool created.")
+            return self._pool
+
+    # Drop every pooled connection, e.g. at shutdown
+    def reset(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+            self._pool = None
+            self._last_used = {}
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        db_pool = self._ensure_pool()
+        conn = db_pool.getconn()
+        if self._is_healthy(conn):
+            return db_pool, conn
+        # The server went away underneath us: discard this connection and try
+        # a fresh one. Connections other threads hold are left alone; they are
+        # discarded the same way when they fail.
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+        if self._is_healthy(conn):
+            return db_pool, conn
+        db_pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("Could not obtain a healthy database connection")
+
+    # Borrow a connection for the duration of a with block, waiting up to
+    # timeout seconds for one to be free. The transaction is committed on
+    # success and rolled back on error; broken connections are closed instead
+    # of being returned to the pool.
+    @contextmanager
+    def connection(self, timeout=POOL_CHECKOUT_TIMEOUT):
+        if not self._slots.acquire(timeout=timeout):
+            raise pool.PoolError(f"No database connection free after {timeout} seconds")
+        try:
+            with self._borrow() as conn:
+                yield conn
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def _borrow(self):
+        db_pool, conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            broken = broken or conn.closed != 0
+            if broken:
+                # Siblings of a broken connection are likely stale as well, so
+                # make sure they are pinged before their next use
+                self._last_used.clear()
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            if db_pool.closed:
+                if not conn.closed:
+                    conn.close()
+            else:
+                db_pool.putconn(conn, close=broken)
+
+    def closeall(self):
+        self.reset()
@@ -0,0 +1,80 @@
+import numpy as np
+
+# Used when a plot has not been laid out yet and reports no width
+DEFAULT_PLOT_WIDTH = 1000
+
+
+# Drop points whose x or y is missing; x must already be sorted
+def _finite(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = ~(np.isnan(x) | np.isnan(y))
+    return x[keep], y[keep]
+
+
+# Keep the lowest and highest point of each of buckets equal-width x
+# intervals, in their original order. At two buckets per pixel column this
+# draws the same envelope as the full data, spikes included.
+def minmax(x, y, buckets):
+    x, y = _finite(x, y)
+    if len(x) <= 2 * buckets:
+        return x, y
+    span = x[-1] - x[0]
+    if span <= 0:
+        keep = np.unique([np.argmin(y), np.argmax(y)])
+        return x[keep], y[keep]
+    bucket = np.minimum(((x - x[0]) / span * buckets).astype(np.int64), buckets - 1)
+    # x is sorted, so each bucket is a contiguous run of points
+    starts = np.flatnonzero(np.r_[True, np.diff(bucket) != 0])
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(x)]))
+    keep = [_first_per_segment(y == reduce.reduceat(y, starts)[segment], segment)
+            for reduce in (np.minimum, np.maximum)]
+    keep = np.unique(np.concatenate(keep))
+    return x[keep], y[keep]
+
+
+# Index of the first True in mask within each segment
+def _first_per_segment(mask, segment):
+    index = np.flatnonzero(mask)
+    return index[np.r_[True, np.diff(segment[index]) != 0]]
+
+
+# Largest-Triangle-Three-Buckets: keep the first and last point plus, from
+# each of threshold - 2 equal-count buckets, the point forming the largest
+# triangle with the point kept before it and the mean of the next bucket.
+# Keeps the visual shape of a line with a fixed number of points.
+def lttb(x, y, threshold):
+    x, y = _finite(x, y)
+    n = len(x)
+    if threshold < 3 or n <= threshold:
+        return x, y
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # Mean of every bucket, plus the last point as the "next bucket" of the
+    # final one
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    next_x = np.r_[sums_x[1:] / counts[1:], x[-1]]
+    next_y = np.r_[sums_y[1:] / counts[1:], y[-1]]
+
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        bx = x[start:end]
+        by = y[start:end]
+        # Twice the triangle area, vectorized over the bucket
+        area = np.abs((x[previous] - next_x[i]) * (by - y[previous]) - (x[previous] - bx) * (next_y[i] - y[previous]))
+        previous = start + int(np.argmax(area))
+        keep[i + 1] = previous
+    return x[keep], y[keep]
+
+
+# Reduce a series to what a plot width pixels wide can show. Short series
+# come back unchanged (apart from missing points being dropped).
+def downsample(x, y, width, method='minmax'):
+    width = width if width and width > 1 else DEFAULT_PLOT_WIDTH
+    if method == 'lttb':
+        return lttb(x, y, width)
+    return minmax(x, y, width)
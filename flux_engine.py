@@ -0,0 +1,103 @@
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+
+# Keeps a time-ordered sliding window of effluent level readings in memory so
+# the flux over each configured window can be computed without querying
+# sensor_data. Lookups are a binary search over the stored timestamps.
+class FluxEngine:
+    # windows maps a window length in minutes to the MQTT topic its flux is
+    # published on; reactor_id selects the reactor's rows when seeding
+    def __init__(self, windows, reactor_id):
+        self.windows = dict(windows)
+        self.reactor_id = reactor_id
+        self.retention = timedelta(minutes=max(self.windows))
+        self._times = []
+        self._levels = []
+        self._start = 0
+        self._lock = threading.Lock()
+
+    # Load the readings needed to answer the largest window, once at startup
+    def seed(self, conn):
+        cutoff = datetime.now() - self.retention
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT timestamp, effluent_level
+        FROM sensor_data
+        WHERE reactor_id = %s AND timestamp < %s AND effluent_level IS NOT NULL
+        ORDER BY timestamp DESC
+        LIMIT 1;
+        ''', (self.reactor_id, cutoff))
+        rows = cursor.fetchall()
+        cursor.execute('''
+        SELECT timestamp, effluent_level
+        FROM sensor_data
+        WHERE reactor_id = %s AND timestamp >= %s AND effluent_level IS NOT NULL
+        ORDER BY timestamp ASC;
+        ''', (self.reactor_id, cutoff))
+        rows.extend(cursor.fetchall())
+        cursor.close()
+        for timestamp, level in rows:
+            self.add(timestamp, level)
+        return len(rows)
+
+    def add(self, timestamp, level):
+        if timestamp is None or level is None:
+            return
+        ts = timestamp.timestamp()
+        with self._lock:
+            # Readings normally arrive in order; an out-of-order one is
+            # inserted in place to keep the lists sorted
+            if self._times and ts < self._times[-1]:
+                index = bisect_right(self._times, ts, self._start)
+                self._times.insert(index, ts)
+                self._levels.insert(index, float(level))
+            else:
+                self._times.append(ts)
+                self._levels.append(float(level))
+            self._prune(ts - self.retention.total_seconds())
+
+    # Forget readings older than the largest window, keeping the newest one
+    # before the cutoff so a lookup right at the edge still has an answer
+    def _prune(self, cutoff):
+        keep_from = bisect_right(self._times, cutoff, self._start) - 1
+        if keep_from > self._start:
+            self._start = keep_from
+        # Compact occasionally instead of deleting from the head every time
+        if self._start > 1024 and self._start * 2 > len(self._times):
+            del self._times[:self._start]
+            del self._levels[:self._start]
+            self._start = 0
+
+    # Most recent level recorded at or before the given time, or None
+    def level_at(self, timestamp):
+        ts = timestamp.timestamp()
+        with self._lock:
+            index = bisect_right(self._times, ts, self._start) - 1
+            if index < self._start:
+                return None
+            return self._levels[index]
+
+    # Flux for every window as {minutes: flux}; windows with no reading old
+    # enough to compare against report no change
+    def fluxes(self, current_level, now=None):
+        now = now or datetime.now()
+        result = {}
+        for minutes in self.windows:
+            previous_level = self.level_at(now - timedelta(minutes=minutes))
+            if current_level is None or previous_level is None:
+                result[minutes] = 0
+            else:
+                result[minutes] = int(current_level - previous_level)
+        return result
+
+    def publish(self, current_level, mqtt_client, now=None):
+        result = self.fluxes(current_level, now)
+        for minutes, flux in result.items():
+            mqtt_client.publish(self.windows[minutes], flux)
+        return result
+
+    def __len__(self):
+        with self._lock:
+            return len(self._times) - self._start
@@ -0,0 +1,66 @@
+HEATER_STATES = ("off", "on")
+
+
+# PID temperature controller driving the heater relays by time-proportional
+# PWM. The output is a duty between 0 (all heaters off) and the number of
+# heaters: heater1 carries the first unit of duty, heater2 the next, so 1.5
+# means heater1 on for the whole cycle and heater2 for half of it. The duty
+# is fixed at the start of each PWM cycle, so every heater switches at most
+# twice per cycle however often the temperature is read.
+#
+# Anti-windup is by conditional integration: the integral only grows while
+# the output is not saturated, or when the error pulls it back out of
+# saturation. The derivative acts on the measurement, so a ramp step does
+# not kick the output. feedforward is a constant duty added to the output,
+# roughly what it takes to hold temperature against losses.
+class HeaterPID:
+    def __init__(self, kp, ki, kd=0.0, period=300, feedforward=0.0, min_pulse=5, heaters=2):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.period = period
+        self.feedforward = feedforward
+        self.min_pulse = min_pulse
+        self.heaters = heaters
+        self.integral = 0.0
+        self.duty = 0.0
+        self._last_time = None
+        self._last_measurement = None
+        self._cycle_start = None
+
+    # PID output as a duty between 0 and the number of heaters
+    def update(self, setpoint, measurement, now):
+        error = setpoint - measurement
+        dt = 0.0 if self._last_time is None else max(now - self._last_time, 0.0)
+        derivative = 0.0
+        if dt > 0 and self._last_measurement is not None:
+            derivative = -(measurement - self._last_measurement) / dt
+        self._last_time = now
+        self._last_measurement = measurement
+
+        base = self.feedforward + self.kp * error + self.kd * derivative
+        integral = self.integral + error * dt
+        output = base + self.ki * integral
+        if 0 < output < self.heaters or (output >= self.heaters and error < 0) or (output <= 0 and error > 0):
+            self.integral = integral
+        return min(max(base + self.ki * self.integral, 0.0), self.heaters)
+
+    # Heater states ("on"/"off", one per heater) for this point in the PWM
+    # cycle, starting a new cycle with a fresh duty when the last one ended
+    def heater_states(self, setpoint, measurement, now):
+        output = self.update(setpoint, measurement, now)
+        if self._cycle_start is None or now - self._cycle_start >= self.period:
+            self._cycle_start = now
+            self.duty = output
+        into_cycle = now - self._cycle_start
+        states = []
+        for heater in range(self.heaters):
+            on_time = min(max(self.duty - heater, 0.0), 1.0) * self.period
+            # Pulses too short to be worth a relay switch are dropped, and
+            # near-full ones are run for the whole cycle
+            if on_time < self.min_pulse:
+                on_time = 0.0
+            elif on_time > self.period - self.min_pulse:
+                on_time = self.period
+            states.append(HEATER_STATES[into_cycle < on_time])
+        return states
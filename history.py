@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import psycopg2.errors
+
+from rollup import rollup_coverage, rollup_for
+
+# Aim for about this many buckets per series when the caller does not say
+HISTORY_POINTS = 1000
+
+# Bucket sizes in seconds to choose from, smallest first
+BUCKET_SIZES = (
+    1, 5, 10, 30, 60, 120, 300, 600, 900, 1800, 3600,
+    3 * 3600, 6 * 3600, 12 * 3600, 86400, 7 * 86400
+)
+
+# Buckets are aligned to this instant, so the same range always gives the
+# same buckets
+BUCKET_ORIGIN = datetime(2000, 1, 1)
+
+
+def _to_datetime(value):
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return value
+
+
+# Smallest bucket size that keeps the range within points buckets. A plot
+# that has not been laid out yet reports a width of 1, so anything that
+# small falls back to HISTORY_POINTS.
+def bucket_seconds(from_datetime, to_datetime, points=HISTORY_POINTS):
+    points = points if points and points > 1 else HISTORY_POINTS
+    span = (_to_datetime(to_datetime) - _to_datetime(from_datetime)).total_seconds()
+    for size in BUCKET_SIZES:
+        if span / size <= points:
+            return size
+    return BUCKET_SIZES[-1]
+
+
+# Bucket start of a timestamp expression, the same as date_bin(size, expr,
+# BUCKET_ORIGIN) but written out so it also runs on PostgreSQL before 14
+def _bucket_sql(expression):
+    return f"%(origin)s + floor(extract(epoch FROM {expression} - %(origin)s) / %(size)s) * %(size)s * interval '1 second'"
+
+
+# Start of the bucket of a given size that holds a timestamp
+def _bucket_start(timestamp, size):
+    return BUCKET_ORIGIN + timedelta(seconds=(timestamp - BUCKET_ORIGIN).total_seconds() // size * size)
+
+
+def _raw_query(columns):
+    aggregates = ', '.join(f"avg({column}), min({column}), max({column})" for column in columns)
+    return f'''
+    SELECT {_bucket_sql('timestamp')} AS bucket, {aggregates}
+    FROM sensor_data
+    WHERE reactor_id = %(reactor_id)s AND timestamp BETWEEN %(raw_from)s AND %(to)s
+    GROUP BY bucket
+    ORDER BY bucket
+    '''
+
+
+# Same buckets built from a rollup table, whose buckets divide them evenly,
+# for the buckets that start before %(split)s
+def _rollup_query(columns, table, field):
+    aggregates = ', '.join(
+        f"sum({column}_sum) / NULLIF(sum({column}_count), 0), min({column}_min), max({column}_max)"
+        for column in columns
+    )
+    return f'''
+    SELECT {_bucket_sql('bucket')} AS history_bucket, {aggregates}
+    FROM {table}
+    WHERE reactor_id = %(reactor_id)s AND bucket >= date_trunc('{field}', %(from)s::timestamp) AND bucket <= %(to)s
+      AND bucket < %(split)s
+    GROUP BY history_bucket
+    ORDER BY history_bucket
+    '''
+
+
+# Time-bucketed avg/min/max of columns of one reactor's sensor_data,
+# aggregated in PostgreSQL so only one row per bucket leaves the database.
+# Buckets of a minute or more are built from the coarsest rollup table that
+# divides them (see rollup.py), so long ranges cost the same however much
+# raw data there is. The rollups only serve buckets that end before the
+# newest reading folded into them; later buckets, shorter buckets, and
+# everything while the rollups are missing or still empty come from the raw
+# rows. Returns a frame of timestamp (bucket start) plus <column>,
+# <column>_min and <column>_max for every column, and the bucket size.
+def fetch_history(cursor, reactor_id, columns, from_datetime, to_datetime, points=HISTORY_POINTS):
+    size = bucket_seconds(from_datetime, to_datetime, points)
+    params = {
+        'origin': BUCKET_ORIGIN, 'size': size, 'reactor_id': reactor_id,
+        'from': from_datetime, 'to': to_datetime, 'raw_from': from_datetime
+    }
+    rows = []
+    rollup = rollup_for(size)
+    if rollup is not None:
+        try:
+            covered = rollup_coverage(cursor)
+        except (psycopg2.errors.UndefinedTable, psycopg2.errors.UndefinedColumn):
+            cursor.connection.rollback()
+            covered = None
+        if covered is not None:
+            params['split'] = _bucket_start(covered, size)
+            if params['split'] > _to_datetime(from_datetime):
+                cursor.execute(_rollup_query(columns, *rollup), params)
+                rows = cursor.fetchall()
+                params['raw_from'] = params['split']
+    if _to_datetime(params['raw_from']) <= _to_datetime(to_datetime):
+        cursor.execute(_raw_query(columns), params)
+        rows += cursor.fetchall()
+
+    names = ['timestamp'] + [name for column in columns for name in (column, f'{column}_min', f'{column}_max')]
+    data = pd.DataFrame(rows, columns=names)
+    data['timestamp'] = pd.to_datetime(data['timestamp'])
+    data = data.astype({name: float for name in names[1:]})
+    return data, timedelta(seconds=size)
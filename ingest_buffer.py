@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from db_pool import DB_QUERY_SECONDS
+from spool import REJECTED_SUFFIX
+
+# Column order of the rows handed to IngestWriter.append
+SENSOR_DATA_COLUMNS = (
+    'timestamp', 'cstr_temp', 'cstr_level', 'cstr_ph', 'cstr_orp', 'cstr_ec', 'cstr_tds',
+    'mtank_temp', 'mtank_level', 'effluent_level', 'flux', 'published', 'weight', 'reactor_id'
+)
+
+INSERT_QUERY = f"INSERT INTO sensor_data ({', '.join(SENSOR_DATA_COLUMNS)}) VALUES %s"
+
+
+# Buffers every sensor reading in memory and writes them to sensor_data in
+# bulk once either the row or the time threshold of the flush policy is hit.
+# The buffer is a ring: when the database stays unreachable for long enough
+# to fill it, the oldest readings are dropped first. With a spool attached,
+# readings that fail to flush go to disk instead and are replayed in bulk
+# once the database accepts writes again. on_flush, if given, is called
+# after every flush that wrote rows. prepare, if given, sets up the schema
+# the rows need; it is retried before every write until it succeeds once.
+class IngestWriter:
+    def __init__(self, db_pool, capacity=10000, flush_rows=200, flush_interval=30, spool=None, on_flush=None, prepare=None):
+        self.db_pool = db_pool
+        self.spool = spool
+        self.on_flush = on_flush
+        self.prepare = prepare
+        self._prepared = prepare is None
+        self._prepare_lock = threading.Lock()
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._buffer = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.dropped = 0
+        self.written = 0
+        self.spooled = 0
+
+    # Queue one row (a sequence in SENSOR_DATA_COLUMNS order). Cheap enough to
+    # call from the MQTT network thread.
+    def append(self, row):
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(tuple(row))
+            pending = len(self._buffer)
+        if pending >= self.flush_rows:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    # Run prepare unless it has already succeeded; raises if it fails
+    def ensure_prepared(self):
+        with self._prepare_lock:
+            if not self._prepared:
+                self.prepare()
+                self._prepared = True
+
+    def _insert(self, conn, rows):
+        cursor = conn.cursor()
+        with DB_QUERY_SECONDS.time('insert_sensor_data'):
+            execute_values(cursor, INSERT_QUERY, rows, page_size=len(rows))
+        cursor.close()
+
+    # Write everything buffered so far in one multi-row INSERT, then replay
+    # the spool if it holds anything. Rows that fail to write go to the
+    # spool, or back to the front of the buffer when there is no spool.
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._buffer)
+                self._buffer.clear()
+            if rows:
+                try:
+                    self.ensure_prepared()
+                    with self.db_pool.connection() as conn:
+                        self._insert(conn, rows)
+                except Exception:
+                    self._spool_or_requeue(rows)
+                    raise
+                self.written += len(rows)
+            if self.spool is not None and self.spool.pending():
+                self.ensure_prepared()
+                self._replay()
+            return len(rows)
+
+    def _spool_or_requeue(self, rows):
+        if self.spool is not None:
+            try:
+                self.spool.append(rows)
+                self.spooled += len(rows)
+                return
+            except OSError as e:
+                print(f"Error writing readings to spool: {e}")
+        self._requeue(rows)
+
+    # Insert a chunk of spooled rows inside a savepoint. If the database
+    # refuses the chunk's data, retry it row by row and return the rows it
+    # still refuses; connection errors propagate.
+    def _insert_or_reject(self, conn, rows):
+        cursor = conn.cursor()
+        cursor.execute("SAVEPOINT replay_chunk")
+        try:
+            self._insert(conn, rows)
+            return []
+        except (psycopg2.DataError, psycopg2.IntegrityError):
+            cursor.execute("ROLLBACK TO SAVEPOINT replay_chunk")
+        rejected = []
+        for row in rows:
+            cursor.execute("SAVEPOINT replay_row")
+            try:
+                self._insert(conn, [row])
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT replay_row")
+                print(f"Rejected spooled reading {row}: {e}")
+                rejected.append(row)
+        cursor.close()
+        return rejected
+
+    # Insert every spooled row in a single transaction and only then discard
+    # the spool, so a failed replay leaves it intact for the next attempt.
+    # Rows the database refuses (bad values, constraint violations) are moved
+    # to the spool's rejected file instead, so one bad row cannot stop the
+    # rest from ever being replayed. That file is written before the commit,
+    # so if writing it fails the replay is rolled back too.
+    def _replay(self, chunk_size=1000):
+        replayed = 0
+        rejected = []
+        with self.db_pool.connection() as conn:
+            for rows in self.spool.read_chunks(chunk_size):
+                refused = self._insert_or_reject(conn, rows)
+                rejected.extend(refused)
+                replayed += len(rows) - len(refused)
+            if rejected:
+                self.spool.reject(rejected)
+                print(f"Moved {len(rejected)} rejected spooled readings to {self.spool.path}{REJECTED_SUFFIX}.")
+        self.spool.clear()
+        self.written += replayed
+        print(f"Replayed {replayed} spooled readings into database.")
+
+    def _requeue(self, rows):
+        with self._lock:
+            newer = list(self._buffer)
+            self._buffer.clear()
+            for row in rows + newer:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.dropped += 1
+                self._buffer.append(row)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                count = self.flush()
+                if count:
+                    print(f"Saved {count} readings to database.")
+                    if self.on_flush is not None:
+                        self.on_flush()
+            except Exception as e:
+                print(f"Error saving data to database: {e}")
+                # Avoid hammering the database while it is down
+                time.sleep(min(self.flush_interval, 5))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    # Stop the flusher thread and write out whatever is still buffered. A
+    # failed final flush is only logged: its rows are already spooled (or
+    # lost with the process when there is no spool), and shutdown goes on.
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error saving data to database at shutdown: {e}")
@@ -0,0 +1,216 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, sized for callbacks and queries on the Pi
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, (), value) for labels, value in self._values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            if not self.labels:
+                return self._values.get((), 0)
+            return {','.join(labels): value for labels, value in self._values.items()}
+
+
+# A value read when the metrics are collected: either set directly, or
+# computed by func, which returns a number or a {label tuple: number} dict
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def _collect(self):
+        if self.func is not None:
+            value = self.func()
+            values = value if isinstance(value, dict) else {(): value}
+            with self._lock:
+                self._values = dict(values)
+
+    def samples(self):
+        self._collect()
+        return super().samples()
+
+    def snapshot(self):
+        self._collect()
+        return super().snapshot()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] = max(series[2], value)
+
+    # Time the body of a with block
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for labels, (counts, total, _) in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    result.append((f'{self.name}_bucket', labels, (('le', bound),), cumulative))
+                result.append((f'{self.name}_sum', labels, (), total))
+                result.append((f'{self.name}_count', labels, (), cumulative))
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                ','.join(labels): {
+                    'count': sum(counts),
+                    'avg': total / sum(counts) if sum(counts) else 0.0,
+                    'max': maximum,
+                }
+                for labels, (counts, total, maximum) in self._series.items()
+            }
+
+
+# Holds the metrics of one process and renders them as Prometheus text or
+# JSON. Modules create their instruments on the shared REGISTRY at import
+# time; the daemons add gauges over their own objects and call serve().
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self.started = time.time()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._register(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _collect(self, render):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = []
+        for metric in metrics:
+            try:
+                result.append(render(metric))
+            except Exception as e:
+                print(f"Error collecting metric {metric.name}: {e}")
+        return result
+
+    # Prometheus text exposition format
+    def render(self):
+        def render_metric(metric):
+            lines = [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {metric.kind}']
+            for name, labels, extra, value in metric.samples():
+                lines.append(f'{name}{_format_labels(metric.labels, labels, extra)} {value}')
+            return '\n'.join(lines)
+        return '\n'.join(self._collect(render_metric)) + '\n'
+
+    def snapshot(self):
+        snapshot = {'uptime_seconds': time.time() - self.started}
+        for name, value in self._collect(lambda metric: (metric.name, metric.snapshot())):
+            snapshot[name] = value
+        return snapshot
+
+    # Serve /metrics (Prometheus) and /metrics.json on a background thread
+    def serve(self, port, host='127.0.0.1'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = registry.render().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(registry.snapshot(), default=str).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a line on stdout each
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+REGISTRY = Registry()
@@ -1,212 +1,169 @@
 import paho.mqtt.client as mqtt
-import psycopg2
-import time
+import os
 import threading
+import time
 from datetime import datetime, timedelta
+from topics import CONTROL_TOPICS, REACTORS, ROUTES, reactor_topic
+from scheduler import Scheduler
+from control_engine import ControlEngine
+from settings_listener import install_settings_trigger
+from control_rules import load_reactor_configs, reactor_config
+from metrics import REGISTRY
 
 # MQTT settings
 broker = "192.168.18.19"
 port = 1883
-topics = ['cstr-temp', 'cstr-level', 'mtank-temp', 'mtank-level']
+topics = [reactor_topic(reactor_id, name) for reactor_id in REACTORS for name in CONTROL_TOPICS]
 
 # Database settings
 dbname = "sensordata"
 user = "postgres"
 password = "399584"
 host = "localhost"
-table = "temp_setting"
+db_config = {'dbname': dbname, 'user': user, 'password': password, 'host': host}
+
+# Control thresholds per reactor; without this file every reactor in
+# topics.REACTORS runs on the built-in defaults
+REACTOR_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reactors.json')
+if os.path.exists(REACTOR_CONFIG_PATH):
+    reactor_configs = load_reactor_configs(REACTOR_CONFIG_PATH)
+else:
+    reactor_configs = {reactor_id: reactor_config() for reactor_id in REACTORS}
+
+# Periodic job intervals in seconds; the ramp interval comes from each reactor's config
+CONFIRM_CHECK_INTERVAL = 5
 
-# Connect to PostgreSQL database
-conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host)
-cursor = conn.cursor()
+# Sensor readings arriving within this many seconds share one control pass
+COALESCE_WINDOW = 0.05
+
+# Port of the /metrics and /metrics.json endpoint
+METRICS_PORT = 9102
+
+# Seconds between attempts to install the settings change trigger
+SETTINGS_TRIGGER_RETRY = 30
+
+MQTT_MESSAGES = REGISTRY.counter('mqtt_messages_total', 'MQTT messages received', ('topic',))
+MQTT_CALLBACK_SECONDS = REGISTRY.histogram('mqtt_callback_seconds', 'Time spent in the MQTT message callback in seconds')
 
 # MQTT client setup
 client = mqtt.Client()
 
-# Global variables for sensor values and previous states
-sensor_values = {
-    "cstr-temp": None,
-    "cstr-level": None,
-    "mtank-temp": None,
-    "mtank-level": None
-}
-previous_states = {
-    "cstr/in": None,
-    "cstr/heater1": None,
-    "cstr/heater2": None,
-    "mtank/out": None,
-    "mtank/in": None,
-    "mtank-recycle": None
+# Single thread running all periodic jobs
+scheduler = Scheduler()
+
+# One control engine per reactor, each fed through its own ordered event
+# queue. Settings changes are pushed from the database on each engine's
+# own connection.
+def make_engine(reactor_id, config):
+    ramp_job = f"temp_ramp:{reactor_id}"
+    return ControlEngine(
+        client, config, db_config,
+        on_ramp_reset=lambda: scheduler.reschedule(ramp_job, config["ramp_interval"]),
+        coalesce_window=COALESCE_WINDOW,
+        reactor_id=reactor_id
+    )
+
+engines = {reactor_id: make_engine(reactor_id, config) for reactor_id, config in reactor_configs.items()}
+
+# Relay state topic -> (reactor_id, relay) for the confirmation path
+relay_state_routes = {
+    state_topic: (reactor_id, relay)
+    for reactor_id, engine in engines.items()
+    for state_topic, relay in engine.state_topics.items()
 }
-current_temp_settings = {
-    "set_temp": None,
-    "over_duration": None,
-    "temp_change": None
-}
-target_temp = None
-last_temp_change_time = time.time()
-
-# Hysteresis values
-hysteresis = 0.5  # Adjust as needed
 
-# Global maximum cstr level
-max_cstr_level = 24.50
+# Function to install the settings change trigger, retrying until the
+# database accepts it
+def install_settings_trigger_until_done():
+    while True:
+        try:
+            install_settings_trigger(db_config)
+            print("Settings change trigger installed.")
+            return
+        except Exception as e:
+            print(f"Error installing settings change trigger: {e}")
+            time.sleep(SETTINGS_TRIGGER_RETRY)
+
+# Broker acknowledgements of QoS 1 relay commands
+publish_acks = 0
+
+# Callback when the broker acknowledges a publish
+def on_publish(client, userdata, mid):
+    global publish_acks
+    publish_acks += 1
 
 # Callback when a message is received
 def on_message(client, userdata, message):
-    global sensor_values
-    sensor_values[message.topic] = float(message.payload.decode("utf-8"))
-
-    # Control logic
-    cstr_control()
-    mtank_control()
-
-# Function to get temp settings from database
-def get_temp_settings():
-    cursor.execute(f"SELECT set_temp, over_duration, temp_change FROM {table} ORDER BY id DESC LIMIT 1")
-    return cursor.fetchone()
-
-# Function to update temp settings
-def update_temp_settings():
-    global current_temp_settings, last_temp_change_time, target_temp
-    new_settings = get_temp_settings()
-    if new_settings:
-        current_temp_settings = {
-            "set_temp": new_settings[0],
-            "over_duration": new_settings[1],
-            "temp_change": new_settings[2]
-        }
-        # Recalculate target_temp with new settings and reset last_temp_change_time
-        if sensor_values["cstr-temp"] is not None:
-            target_temp = sensor_values["cstr-temp"] + current_temp_settings["temp_change"]
-            last_temp_change_time = time.time()
-
-    # Ensure control logic is applied with updated settings
-    cstr_control()
-    mtank_control()
-
-# Function to publish MQTT messages only on state change
-def publish_state(topic, state):
-    if previous_states[topic] != state:
-        client.publish(topic, state)
-        previous_states[topic] = state
-
-def cstr_control():
-    global last_temp_change_time, target_temp
-    set_temp = current_temp_settings["set_temp"]
-    temp_change = current_temp_settings["temp_change"]
-    current_time = time.time()
-
-    if set_temp is None or temp_change is None or sensor_values["cstr-temp"] is None:
+    MQTT_MESSAGES.inc(message.topic)
+    with MQTT_CALLBACK_SECONDS.time():
+        handle_message(message)
+
+def handle_message(message):
+    relay_route = relay_state_routes.get(message.topic)
+    if relay_route is not None:
+        reactor_id, relay = relay_route
+        engines[reactor_id].submit_relay_state(relay, message.payload.decode().strip())
         return
-
-    # Ensure cstr/in is off if cstr-level is above max_cstr_level
-    if sensor_values["cstr-level"] is not None:
-        if sensor_values["cstr-level"] >= max_cstr_level:
-            publish_state("cstr/in", "off")
-
-    if sensor_values["cstr-temp"] is not None:
-        if (current_time - last_temp_change_time) >= 3600:  # Check every hour
-            target_temp = sensor_values["cstr-temp"] + temp_change
-            print(target_temp)
-            last_temp_change_time = current_time
-
-        if target_temp is not None and target_temp >= set_temp:
-            # Ensure the temperature does not fall below the set temperature
-            if sensor_values["cstr-temp"] < set_temp:
-                publish_state("cstr/heater1", "on")
-                publish_state("cstr/heater2", "off")  # Use only one heater for fine control
-            elif sensor_values["cstr-temp"] >= set_temp:
-                publish_state("cstr/heater1", "off")
-                publish_state("cstr/heater2", "off")
-        elif target_temp is not None:
-            # Maintain temperature at target_temp
-            if sensor_values["cstr-temp"] < target_temp:
-                if target_temp - sensor_values["cstr-temp"] > 1.2:  # Use both heaters if temperature difference is large
-                    publish_state("cstr/heater1", "on")
-                    publish_state("cstr/heater2", "on")
-                else:  # Use only one heater for fine control
-                    publish_state("cstr/heater1", "on")
-                    publish_state("cstr/heater2", "off")
-            else:
-                publish_state("cstr/heater1", "off")
-                publish_state("cstr/heater2", "off")
-
-
-def mtank_control():
-    # Ensure mtank/in is always on
-    publish_state("mtank/in", "on")
-    
-    if sensor_values["mtank-level"] is None:
+    route = ROUTES.get(message.topic)
+    if route is None or route[0] not in engines:
         return
-    
-    if sensor_values["mtank-level"] <= 8000:
-        # Ignore mtank-temp and prioritize filling until level reaches 8000 ml
-        publish_state("mtank-recycle", "No")
-        publish_state("mtank/out", "off")
-        
-        if sensor_values["cstr-level"] is not None and sensor_values["cstr-level"] < max_cstr_level:
-            publish_state("cstr/in", "on")
-    else:
-        temp_override = False
-
-        if sensor_values["mtank-temp"] is not None and sensor_values["cstr-temp"] is not None:
-            # Apply hysteresis to prevent rapid switching
-            if sensor_values["mtank-temp"] <= (sensor_values["cstr-temp"] - 5 - hysteresis):
-                publish_state("mtank-recycle", "Yes")
-                publish_state("mtank/out", "on")
-                
-                if sensor_values["cstr-level"] is not None and sensor_values["cstr-level"] < max_cstr_level:
-                    publish_state("cstr/in", "off")
-                temp_override = True
-            elif sensor_values["mtank-temp"] >= (sensor_values["cstr-temp"] - 5 + hysteresis):
-                publish_state("mtank-recycle", "No")
-                publish_state("mtank/out", "off")
-                
-                if sensor_values["cstr-level"] is not None and sensor_values["cstr-level"] < max_cstr_level:
-                    publish_state("cstr/in", "on")
-                temp_override = True
-
-        if not temp_override and sensor_values["mtank-level"] is not None:
-            if sensor_values["mtank-level"] > 8200:
-                publish_state("mtank-recycle", "Yes")
-                publish_state("mtank/out", "on")
-                if sensor_values["cstr-level"] is not None and sensor_values["cstr-level"] < max_cstr_level:
-                    publish_state("cstr/in", "off")
-            elif sensor_values["mtank-level"] <= 8200:
-                publish_state("mtank-recycle", "No")
-                publish_state("mtank/out", "off")
-                if sensor_values["cstr-level"] is not None and sensor_values["cstr-level"] < max_cstr_level:
-                    publish_state("cstr/in", "on")
-
-
-# Periodic status update
-def periodic_status_update():
-    threading.Timer(120, periodic_status_update).start()  # Schedule the function to run every 2 minutes
-    for topic in previous_states:
-        if previous_states[topic] is not None:
-            client.publish(topic, previous_states[topic])
-
-# Periodic database check
-def periodic_db_check():
-    threading.Timer(10, periodic_db_check).start()  # Check database every 10 seconds for new settings
-    update_temp_settings()
+    reactor_id, topic = route
+    try:
+        value = topic.decode(message.payload)
+    except ValueError as e:
+        print(f"Ignoring reading on {message.topic}: {e}")
+        return
+    engines[reactor_id].submit_sensor(topic.name, value)
+
+# Gauges over the engines and the scheduler, read on every scrape
+REGISTRY.gauge('control_queue_events', 'Events waiting for the control engine', ('reactor',),
+               func=lambda: {(reactor_id,): engine.backlog() for reactor_id, engine in engines.items()})
+REGISTRY.gauge('control_evaluations', 'Control passes since start', ('reactor', 'kind'), func=lambda: {
+    key: value for reactor_id, engine in engines.items() for key, value in (
+        ((reactor_id, 'run'), engine.evaluations),
+        ((reactor_id, 'saved_by_coalescing'), engine.evaluations_saved),
+    )
+})
+REGISTRY.gauge('relay_resends', 'Relay commands resent for lack of state confirmation', ('reactor',),
+               func=lambda: {(reactor_id,): engine.republished for reactor_id, engine in engines.items()})
+REGISTRY.gauge('relay_switches', 'Relay state changes since start', ('reactor', 'relay'), func=lambda: {
+    (reactor_id, relay): count
+    for reactor_id, engine in engines.items()
+    for relay, count in engine.switch_counts.items()
+})
+REGISTRY.gauge('heater_rms_temp_error', 'RMS difference between cstr-temp and the heating setpoint', ('reactor',),
+               func=lambda: {(reactor_id,): engine.heater_metrics()['rms_temp_error'] for reactor_id, engine in engines.items()})
+REGISTRY.gauge('relay_publish_acks', 'Relay commands acknowledged by the broker', func=lambda: publish_acks)
+REGISTRY.gauge('scheduler_max_lateness_seconds', 'Largest delay of a periodic job behind its due time', ('job',),
+               func=lambda: {(name,): job['max_lateness'] for name, job in scheduler.metrics().items()})
 
 # MQTT connection setup
 client.on_message = on_message
+client.on_publish = on_publish
 client.connect(broker, port)
 
 # Subscribe to topics
 for topic in topics:
     client.subscribe(topic)
-
-# Start MQTT loop
+for topic in relay_state_routes:
+    client.subscribe(topic, qos=1)
+
+# Start periodic jobs, the control engines and the MQTT loop
+for reactor_id, engine in engines.items():
+    ramp_interval = engine.config["ramp_interval"]
+    scheduler.add(f"confirm_relays:{reactor_id}", CONFIRM_CHECK_INTERVAL, engine.submit_confirm_check)
+    scheduler.add(f"temp_ramp:{reactor_id}", ramp_interval, engine.submit_ramp_step, delay=ramp_interval)
+    if engine.heater_tick_interval is not None:
+        scheduler.add(f"heater_tick:{reactor_id}", engine.heater_tick_interval, engine.submit_heater_tick)
+scheduler.start()
+REGISTRY.serve(METRICS_PORT)
+for engine in engines.values():
+    engine.start()
+# Settings listeners only LISTEN; the trigger they rely on is set up once,
+# off the main thread so a busy or unreachable database cannot hold up control
+threading.Thread(target=install_settings_trigger_until_done, name='settings-trigger', daemon=True).start()
 client.loop_start()
 
-# Start periodic status updates and database checks
-periodic_status_update()
-periodic_db_check()
-
 try:
     while True:
         time.sleep(1)
@@ -214,5 +171,12 @@ except KeyboardInterrupt:
     print("Exiting")
 finally:
     client.loop_stop()
-    cursor.close()
-    conn.close()
+    for engine in engines.values():
+        engine.stop()
+    scheduler.stop()
+    REGISTRY.stop()
+    print(f"Scheduler metrics: {scheduler.metrics()}")
+    for reactor_id, engine in engines.items():
+        print(f"{reactor_id} control evaluations: {engine.evaluations}, saved by coalescing: {engine.evaluations_saved}, relay commands resent: {engine.republished}")
+        print(f"{reactor_id} heater metrics: {engine.heater_metrics()}")
+    print(f"Relay commands acknowledged by broker: {publish_acks}")
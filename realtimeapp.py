@@ -5,6 +5,7 @@ from tkinter import Menu, filedialog, messagebox
 import psycopg2
 import pandas as pd
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
 from tkcalendar import DateEntry
 from datetime import datetime, timedelta
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -12,40 +13,35 @@ import paho.mqtt.client as mqtt
 import threading
 import time
 import os
+from topics import TOPICS, REACTORS, ROUTES, DEFAULT_REACTOR, reactor_topic
+from history import fetch_history
 
 # MQTT Configuration
 MQTT_BROKER = "192.168.18.19"
 MQTT_PORT = 1883
-MQTT_TOPICS = {
-    "cstr-ph": "cstr_ph",
-    "cstr-ec": "cstr_ec",
-    "cstr-tds": "cstr_tds",
-    "cstr-orp": "cstr_orp",
-    "cstr-temp": "cstr_temp",
-    "cstr-level": "cstr_level",
-    "mtank-temp": "mtank_temp",
-    "mtank-level": "mtank_level",
-    "mtank-recycle": "mtank_recycle",
-    "effluent-temp": "effluent_temp",
-    "effluent-level": "effluent_level",
-    "flux": "flux",
-    "weight": "weight"
-}
-
-# Initialize MQTT values storage
-mqtt_values = {topic: None for topic in MQTT_TOPICS.keys()}
+MQTT_TOPICS = {name: topic.column for name, topic in TOPICS.items()}
+
+# Initialize MQTT values storage for every reactor; mqtt_values holds the
+# values of the reactor currently shown
+reactor_values = {reactor_id: {topic: None for topic in MQTT_TOPICS.keys()} for reactor_id in REACTORS}
+selected_reactor = DEFAULT_REACTOR
+mqtt_values = reactor_values[selected_reactor]
 
 # MQTT callback functions
 def on_connect(client, userdata, flags, rc):
     print(f"Connected with result code {rc}")
-    for topic in MQTT_TOPICS.keys():
-        client.subscribe(topic)
+    for reactor_id in REACTORS:
+        for topic in MQTT_TOPICS.keys():
+            client.subscribe(reactor_topic(reactor_id, topic))
 
 def on_message(client, userdata, msg):
-    topic = msg.topic
-    value = msg.payload.decode()
-    mqtt_values[topic] = value
-    update_ui_values()
+    route = ROUTES.get(msg.topic)
+    if route is None:
+        return
+    reactor_id, topic = route
+    reactor_values[reactor_id][topic.name] = msg.payload.decode()
+    if reactor_id == selected_reactor:
+        update_ui_values()
 
 # Initialize MQTT client and connect
 mqtt_client = mqtt.Client()
@@ -68,19 +64,24 @@ def fetch_and_display_timeseries(param, from_date, to_date, canvas, figure, pare
         conn = psycopg2.connect(
             dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
         )
-        query = f"SELECT timestamp, {param} FROM sensor_data WHERE timestamp BETWEEN '{from_date}' AND '{to_date}'"
-        df = pd.read_sql_query(query, conn)
+        # One bucket per pixel of the canvas, averaged in the database
+        cursor = conn.cursor()
+        df, bucket = fetch_history(cursor, selected_reactor, [param], from_date, to_date, canvas.get_tk_widget().winfo_width())
+        cursor.close()
         conn.close()
 
         if df.empty:
             messagebox.showinfo("No Data", "No data found for the selected range.")
             return
 
-        # Plotting the data
+        # Bucket averages with the min/max range of each bucket shaded
+        times = mdates.date2num(df['timestamp'])
+        figure.clear()
         ax = figure.add_subplot(111)
-        ax.clear()
-        ax.plot(pd.to_datetime(df['timestamp']), df[param], marker='o', linestyle='-')
-        ax.set_title(f'Time Series Data for {param}')
+        ax.xaxis_date()
+        ax.fill_between(times, df[f'{param}_min'], df[f'{param}_max'], alpha=0.3, linewidth=0)
+        ax.plot(times, df[param], linestyle='-')
+        ax.set_title(f'Time Series Data for {param} ({bucket} buckets)')
         ax.set_xlabel('Timestamp')
         ax.set_ylabel(param)
         ax.grid(True)
@@ -101,7 +102,7 @@ def save_graph_as_image(figure, parent_window):
 # Function to open the time series window
 def open_timeseries_window(param):
     timeseries_window = CTkToplevel()
-    timeseries_window.title(f"Time Series Graph for {param}")
+    timeseries_window.title(f"Time Series Graph for {param} ({selected_reactor})")
     timeseries_window.geometry("800x600")
 
     # Ensure the window is visible before grabbing
@@ -166,12 +167,13 @@ def open_timeseries_window(param):
 def on_param_frame_click(param):
     open_timeseries_window(param)
     
-# Function to publish settings to MQTT topics
-def publish_settings():
+# Function to publish a reactor's settings to its MQTT topics
+def publish_settings(reactor_id):
+    values = reactor_values[reactor_id]
     try:
-        mqtt_client.publish('set-temp', mqtt_values['set-temp'])
-        mqtt_client.publish('over-duration', mqtt_values['over-duration'])
-        mqtt_client.publish('temp-change', mqtt_values['temp-change'])
+        for topic in ('set-temp', 'over-duration', 'temp-change'):
+            if values.get(topic) is not None:
+                mqtt_client.publish(reactor_topic(reactor_id, topic), values[topic])
     except Exception as e:
         print(f"Error publishing settings: {e}")
 
@@ -180,6 +182,7 @@ def save_settings(set_temp_input, over_duration_input, temp_change_input, settin
     set_temp = set_temp_input.get()
     over_duration = over_duration_input.get()
     temp_change = temp_change_input.get()
+    reactor_id = selected_reactor
 
     try:
         conn = psycopg2.connect(
@@ -188,18 +191,19 @@ def save_settings(set_temp_input, over_duration_input, temp_change_input, settin
         now = datetime.now()
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO temp_setting (timestamp, set_temp, over_duration, temp_change, published) VALUES (%s, %s, %s, %s, %s)",
-            (now, set_temp, over_duration, temp_change, False)
+            "INSERT INTO temp_setting (timestamp, set_temp, over_duration, temp_change, published, reactor_id) VALUES (%s, %s, %s, %s, %s, %s)",
+            (now, set_temp, over_duration, temp_change, False, reactor_id)
         )
         conn.commit()
         cursor.close()
         conn.close()
 
         # Update MQTT values and publish them
-        mqtt_values['set-temp'] = set_temp
-        mqtt_values['over-duration'] = over_duration
-        mqtt_values['temp-change'] = temp_change
-        publish_settings()
+        values = reactor_values[reactor_id]
+        values['set-temp'] = set_temp
+        values['over-duration'] = over_duration
+        values['temp-change'] = temp_change
+        publish_settings(reactor_id)
 
         messagebox.showinfo("Success", "Settings have been saved successfully.")
         settings_window.destroy()
@@ -210,7 +214,7 @@ def save_settings(set_temp_input, over_duration_input, temp_change_input, settin
 # Function to open the settings window and fetch the latest settings
 def open_settings():
     settings_window = CTkToplevel()
-    settings_window.title("Settings")
+    settings_window.title(f"Settings ({selected_reactor})")
     settings_window.geometry("600x400")
 
     # Ensure the window is visible before grabbing
@@ -234,7 +238,7 @@ def open_settings():
             dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
         )
         cursor = conn.cursor()
-        cursor.execute("SELECT set_temp, over_duration, temp_change FROM temp_setting ORDER BY timestamp DESC LIMIT 1")
+        cursor.execute("SELECT set_temp, over_duration, temp_change FROM temp_setting WHERE reactor_id = %s ORDER BY timestamp DESC LIMIT 1", (selected_reactor,))
         latest_settings = cursor.fetchone()
         conn.close()
 
@@ -250,7 +254,8 @@ def open_settings():
 # Function to periodically publish settings to MQTT topics every 30 seconds
 def periodically_publish_settings():
     while True:
-        publish_settings()
+        for reactor_id in REACTORS:
+            publish_settings(reactor_id)
         time.sleep(30)
 
 # Start the periodic publishing in a separate thread
@@ -267,8 +272,8 @@ def download_data(from_date_input, to_date_input, download_window):
         conn = psycopg2.connect(
             dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
         )
-        query = f"SELECT * FROM sensor_data WHERE timestamp BETWEEN '{from_date}' AND '{to_date}'"
-        df = pd.read_sql_query(query, conn)
+        query = "SELECT * FROM sensor_data WHERE reactor_id = %s AND timestamp BETWEEN %s AND %s"
+        df = pd.read_sql_query(query, conn, params=(selected_reactor, from_date, to_date))
         file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")], initialdir="/home/resurgencemd/pictures")
         if file_path:
             df.to_csv(file_path, index=False)
@@ -312,6 +317,19 @@ app.config(menu=menu_bar)
 menu_bar.add_command(label="Settings", command=open_settings)
 menu_bar.add_command(label="Download", command=open_download)
 
+# Function to switch the dashboard to another reactor
+def select_reactor():
+    global selected_reactor, mqtt_values
+    selected_reactor = reactor_var.get()
+    mqtt_values = reactor_values[selected_reactor]
+    update_ui_values()
+
+reactor_var = tk.StringVar(value=selected_reactor)
+reactor_menu = Menu(menu_bar, tearoff=0)
+for reactor_id in REACTORS:
+    reactor_menu.add_radiobutton(label=reactor_id, variable=reactor_var, value=reactor_id, command=select_reactor)
+menu_bar.add_cascade(label="Reactor", menu=reactor_menu)
+
 # Load logos
 left_logo_image = Image.open("/home/resurgencemd/pythonscripts/nust-logo.png")
 right_logo_image = Image.open("/home/resurgencemd/pythonscripts/resurgence_logo.png")
@@ -336,26 +354,15 @@ title_label.grid(row=0, column=1, pady=10)
 
 sections = ["Anaerobic CSTR", "Membrane Tank", "Effluent"]
 
-anaerobic_cstr_params = [
-    ("PH", "cstr-ph", "cstr_ph", " /14"),
-    ("TDS", "cstr-tds", "cstr_tds", " PPM"),
-    ("ORP", "cstr-orp", "cstr_orp", " mV"),
-    ("Temp", "cstr-temp", "cstr_temp", " °C"),
-    ("EC", "cstr-ec", "cstr_ec", " mS/cm"),
-    ("Level", "cstr-level", "cstr_level", " Liters"),
-]
-
-membrane_tank_params = [
-    ("Temp", "mtank-temp", "mtank_temp", " °C"),
-    ("Level", "mtank-level", "mtank_level", " mL"),
-    ("Recycle", "mtank-recycle", "mtank_recycle", " ")
-]
-
-effluent_params = [
-    ("Level", "effluent-level", "effluent_level", " mL"),
-    ("Weight", "weight", "weight", " g"),
-    ("Flux", "flux", "flux", " mL/min")
-]
+# (label, topic, column, unit) for each displayed parameter, from the topic registry
+def display_params(names):
+    return [(TOPICS[name].label, name, TOPICS[name].column, f" {TOPICS[name].unit}") for name in names]
+
+anaerobic_cstr_params = display_params(["cstr-ph", "cstr-tds", "cstr-orp", "cstr-temp", "cstr-ec", "cstr-level"])
+
+membrane_tank_params = display_params(["mtank-temp", "mtank-level", "mtank-recycle"])
+
+effluent_params = display_params(["effluent-level", "weight", "flux"])
 
 parameters = [anaerobic_cstr_params, membrane_tank_params, effluent_params]
 
@@ -0,0 +1,228 @@
+import threading
+
+# Channels of sensor_data summarised in the rollup tables
+ROLLUP_COLUMNS = (
+    'cstr_temp', 'cstr_level', 'cstr_ph', 'cstr_orp', 'cstr_ec', 'cstr_tds',
+    'mtank_temp', 'mtank_level', 'effluent_level', 'flux', 'weight'
+)
+
+# Rollup tables from finest to coarsest: table, bucket size in seconds and
+# the date_trunc field that makes its buckets. Each level is built from the
+# one before it, the first from sensor_data.
+ROLLUPS = (
+    ('sensor_data_1m', 60, 'minute'),
+    ('sensor_data_1h', 3600, 'hour'),
+    ('sensor_data_1d', 86400, 'day'),
+)
+
+# Raw rows folded into the rollups per transaction
+ROLLUP_BATCH_ROWS = 50000
+
+# Seconds between refreshes when nothing asks for one sooner
+ROLLUP_INTERVAL = 60
+
+
+def _table_sql(table):
+    columns = ''.join(
+        f"{column}_count BIGINT NOT NULL DEFAULT 0, {column}_sum DOUBLE PRECISION, "
+        f"{column}_min DOUBLE PRECISION, {column}_max DOUBLE PRECISION, {column}_last DOUBLE PRECISION,\n"
+        for column in ROLLUP_COLUMNS
+    )
+    return f'''
+    CREATE TABLE IF NOT EXISTS {table} (
+        reactor_id TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        last_timestamp TIMESTAMP NOT NULL,
+        {columns}
+        PRIMARY KEY (reactor_id, bucket)
+    )
+    '''
+
+
+def _insert_columns():
+    return ', '.join(
+        ['reactor_id', 'bucket', 'last_timestamp']
+        + [f"{column}_{part}" for column in ROLLUP_COLUMNS for part in ('count', 'sum', 'min', 'max', 'last')]
+    )
+
+
+# Fold a range of raw rows into the finest rollup. Buckets that already hold
+# earlier rows are merged with the new ones rather than replaced.
+def _raw_sql(table, field):
+    aggregates = ''.join(
+        f", count({column}), sum({column}), min({column}), max({column}), "
+        f"(array_agg({column} ORDER BY timestamp DESC) FILTER (WHERE {column} IS NOT NULL))[1]"
+        for column in ROLLUP_COLUMNS
+    )
+    merges = ''.join(
+        f''',
+        {column}_count = r.{column}_count + EXCLUDED.{column}_count,
+        {column}_sum = COALESCE(r.{column}_sum + EXCLUDED.{column}_sum, r.{column}_sum, EXCLUDED.{column}_sum),
+        {column}_min = LEAST(r.{column}_min, EXCLUDED.{column}_min),
+        {column}_max = GREATEST(r.{column}_max, EXCLUDED.{column}_max),
+        {column}_last = CASE WHEN EXCLUDED.{column}_last IS NOT NULL AND EXCLUDED.last_timestamp >= r.last_timestamp
+                        THEN EXCLUDED.{column}_last ELSE COALESCE(r.{column}_last, EXCLUDED.{column}_last) END'''
+        for column in ROLLUP_COLUMNS
+    )
+    return f'''
+    INSERT INTO {table} AS r ({_insert_columns()})
+    SELECT reactor_id, date_trunc('{field}', timestamp), max(timestamp){aggregates}
+    FROM sensor_data
+    WHERE id > %(after_id)s AND id <= %(last_id)s AND timestamp IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT (reactor_id, bucket) DO UPDATE SET
+        last_timestamp = GREATEST(r.last_timestamp, EXCLUDED.last_timestamp){merges}
+    '''
+
+
+# Rebuild the buckets of a coarser rollup that overlap a time range from the
+# level below it
+def _cascade_sql(table, field, source):
+    aggregates = ''.join(
+        f", sum({column}_count), sum({column}_sum), min({column}_min), max({column}_max), "
+        f"(array_agg({column}_last ORDER BY bucket DESC) FILTER (WHERE {column}_last IS NOT NULL))[1]"
+        for column in ROLLUP_COLUMNS
+    )
+    replaces = ''.join(
+        f", {column}_{part} = EXCLUDED.{column}_{part}"
+        for column in ROLLUP_COLUMNS for part in ('count', 'sum', 'min', 'max', 'last')
+    )
+    return f'''
+    INSERT INTO {table} ({_insert_columns()})
+    SELECT reactor_id, date_trunc('{field}', bucket), max(last_timestamp){aggregates}
+    FROM {source}
+    WHERE bucket >= date_trunc('{field}', %(from)s::timestamp)
+      AND bucket < date_trunc('{field}', %(to)s::timestamp) + interval '1 {field}'
+    GROUP BY 1, 2
+    ON CONFLICT (reactor_id, bucket) DO UPDATE SET last_timestamp = EXCLUDED.last_timestamp{replaces}
+    '''
+
+
+def ensure_rollup_tables(conn):
+    cursor = conn.cursor()
+    for table, _, _ in ROLLUPS:
+        cursor.execute(_table_sql(table))
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rollup_watermark (
+        name TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL,
+        last_timestamp TIMESTAMP
+    )
+    ''')
+    cursor.close()
+
+
+# Newest raw timestamp folded into the rollups, or None while nothing has
+# been (or the tables do not exist yet). Buckets that end before it are
+# complete; later readings are only in sensor_data.
+def rollup_coverage(cursor):
+    cursor.execute('''
+    SELECT last_timestamp FROM rollup_watermark WHERE name = 'sensor_data'
+    ''')
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Coarsest rollup table whose buckets evenly divide a bucket size in seconds,
+# as (table, date_trunc field), or None when only raw rows are fine enough
+def rollup_for(bucket_seconds):
+    for table, size, field in reversed(ROLLUPS):
+        if bucket_seconds >= size and bucket_seconds % size == 0:
+            return table, field
+    return None
+
+
+# Keeps the 1-minute, 1-hour and 1-day summaries of sensor_data (count, sum,
+# min, max and last value of every channel per reactor and bucket) up to
+# date. Raw rows are read past an id watermark, folded into the 1-minute
+# table, and the hours and days they touch are rebuilt from the level below,
+# all in one transaction per batch. The ingest writer is the only writer of
+# sensor_data, so ids become visible in order and nothing is skipped.
+# Refreshes run on their own thread so the first backfill of a long history
+# never holds up ingestion. The tables must already exist; the daemon creates
+# them once at startup with ensure_rollup_tables.
+class RollupRefresher:
+    def __init__(self, db_pool, batch_rows=ROLLUP_BATCH_ROWS, interval=ROLLUP_INTERVAL):
+        self.db_pool = db_pool
+        self.batch_rows = batch_rows
+        self.interval = interval
+        self._raw_sql = _raw_sql(ROLLUPS[0][0], ROLLUPS[0][2])
+        self._cascade_sql = [
+            _cascade_sql(table, field, source)
+            for (table, _, field), (source, _, _) in zip(ROLLUPS[1:], ROLLUPS)
+        ]
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.rows = 0
+
+    def _load_watermark(self, cursor):
+        cursor.execute("SELECT last_id FROM rollup_watermark WHERE name = 'sensor_data'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    # The watermark also keeps the newest timestamp folded so far, which is
+    # how far the rollups can be trusted (see rollup_coverage)
+    def _save_watermark(self, cursor, last_id, last_timestamp):
+        cursor.execute('''
+        INSERT INTO rollup_watermark AS w (name, last_id, last_timestamp) VALUES ('sensor_data', %s, %s)
+        ON CONFLICT (name) DO UPDATE SET
+            last_id = EXCLUDED.last_id,
+            last_timestamp = GREATEST(w.last_timestamp, EXCLUDED.last_timestamp)
+        ''', (last_id, last_timestamp))
+
+    # Fold every row past the watermark into the rollups and return how many
+    # rows that was
+    def refresh(self):
+        refreshed = 0
+        with self.db_pool.connection() as conn:
+            cursor = conn.cursor()
+            after_id = self._load_watermark(cursor)
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM sensor_data")
+            newest_id = cursor.fetchone()[0]
+            conn.commit()
+            while after_id < newest_id and not self._stopped.is_set():
+                last_id = min(after_id + self.batch_rows, newest_id)
+                params = {'after_id': after_id, 'last_id': last_id}
+                cursor.execute(
+                    "SELECT min(timestamp), max(timestamp), count(*) FROM sensor_data WHERE id > %(after_id)s AND id <= %(last_id)s",
+                    params
+                )
+                params['from'], params['to'], count = cursor.fetchone()
+                if count:
+                    cursor.execute(self._raw_sql, params)
+                    for statement in self._cascade_sql:
+                        cursor.execute(statement, params)
+                self._save_watermark(cursor, last_id, params['to'])
+                conn.commit()
+                refreshed += count
+                after_id = last_id
+            cursor.close()
+        self.rows += refreshed
+        return refreshed
+
+    # Ask for a refresh soon, e.g. after new rows were written
+    def request(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing rollups: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='rollup-refresher', daemon=True)
+        self._thread.start()
+        self.request()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,132 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Job:
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = None
+        self.generation = 0
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.max_lateness = 0.0
+
+    def metrics(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'avg_duration': self.total_duration / self.runs if self.runs else 0.0,
+            'max_duration': self.max_duration,
+            'max_lateness': self.max_lateness,
+        }
+
+
+# Runs every periodic job on one thread, ordered by a heap of due times on
+# the monotonic clock. A job's next run is computed from its previous due
+# time rather than from when it finished, so run time does not accumulate
+# as drift; runs missed entirely (e.g. after a long job) are skipped.
+class Scheduler:
+    def __init__(self):
+        self._jobs = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_run, next(self._counter), job.generation, job))
+        self._condition.notify()
+
+    # Register func to run every interval seconds, first after delay seconds
+    # (immediately by default)
+    def add(self, name, interval, func, delay=0):
+        job = Job(name, interval, func)
+        with self._condition:
+            self._jobs[name] = job
+            job.next_run = time.monotonic() + delay
+            self._push(job)
+        return job
+
+    # Move a job's next run to delay seconds from now
+    def reschedule(self, name, delay):
+        with self._condition:
+            job = self._jobs[name]
+            job.generation += 1
+            job.next_run = time.monotonic() + delay
+            self._push(job)
+
+    def metrics(self):
+        with self._condition:
+            return {name: job.metrics() for name, job in self._jobs.items()}
+
+    def _next_due(self):
+        with self._condition:
+            while not self._stopped:
+                # Drop heap entries left behind by reschedule()
+                while self._heap and self._heap[0][2] != self._heap[0][3].generation:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, _, job = self._heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                return job, due
+            return None, None
+
+    def _run_job(self, job, due):
+        started = time.monotonic()
+        job.max_lateness = max(job.max_lateness, started - due)
+        try:
+            job.func()
+        except Exception as e:
+            job.errors += 1
+            print(f"Error in scheduled job {job.name}: {e}")
+        duration = time.monotonic() - started
+        job.runs += 1
+        job.total_duration += duration
+        job.max_duration = max(job.max_duration, duration)
+
+        with self._condition:
+            # reschedule() may have moved the job while it was running
+            if job.next_run != due:
+                return
+            next_run = due + job.interval
+            now = time.monotonic()
+            if next_run <= now:
+                missed = int((now - next_run) // job.interval) + 1
+                job.skipped += missed
+                next_run += missed * job.interval
+            job.next_run = next_run
+            self._push(job)
+
+    def _run(self):
+        while True:
+            job, due = self._next_due()
+            if job is None:
+                return
+            self._run_job(job, due)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
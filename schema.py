@@ -0,0 +1,41 @@
+from topics import DEFAULT_REACTOR
+
+# How long a migration statement may wait for a table lock before giving up,
+# so a reader with an open transaction cannot block a daemon's startup
+SCHEMA_LOCK_TIMEOUT = '5s'
+
+# Adds the reactor dimension to the local tables. Rows written before it
+# existed belong to the default reactor.
+REACTOR_COLUMN_SQL = {
+    table: f"ALTER TABLE {table} ADD COLUMN reactor_id TEXT NOT NULL DEFAULT '{DEFAULT_REACTOR}'"
+    for table in ('sensor_data', 'temp_setting')
+}
+REACTOR_INDEX_SQL = {
+    'sensor_data_reactor_timestamp_idx': "CREATE INDEX sensor_data_reactor_timestamp_idx ON sensor_data (reactor_id, timestamp)",
+}
+
+
+# Run whatever part of the reactor migration is missing. Existing columns and
+# indexes are looked up in the catalog first, because ALTER TABLE and CREATE
+# INDEX lock the table even when IF NOT EXISTS turns them into no-ops. Must
+# run inside a transaction (not autocommit) for the lock timeout to apply.
+def ensure_reactor_columns(conn):
+    cursor = conn.cursor()
+    cursor.execute("SET LOCAL lock_timeout = %s", (SCHEMA_LOCK_TIMEOUT,))
+    cursor.execute('''
+    SELECT table_name FROM information_schema.columns
+    WHERE table_schema = current_schema() AND column_name = 'reactor_id' AND table_name = ANY(%s)
+    ''', (list(REACTOR_COLUMN_SQL),))
+    existing = {row[0] for row in cursor.fetchall()}
+    for table, statement in REACTOR_COLUMN_SQL.items():
+        if table not in existing:
+            cursor.execute(statement)
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND indexname = ANY(%s)",
+        (list(REACTOR_INDEX_SQL),)
+    )
+    existing = {row[0] for row in cursor.fetchall()}
+    for index, statement in REACTOR_INDEX_SQL.items():
+        if index not in existing:
+            cursor.execute(statement)
+    cursor.close()
@@ -0,0 +1,112 @@
+import select
+import threading
+
+import psycopg2
+
+from schema import ensure_reactor_columns
+
+NOTIFY_CHANNEL = 'temp_setting_changed'
+
+# Seconds to wait before reconnecting after the listen connection drops
+RECONNECT_DELAY = 5
+
+# Makes every insert into temp_setting send a notification
+TRIGGER_FUNCTION_SQL = f'''
+CREATE OR REPLACE FUNCTION notify_temp_setting_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{NOTIFY_CHANNEL}', NEW.reactor_id);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+'''
+
+TRIGGER_SQL = '''
+CREATE TRIGGER temp_setting_changed
+    AFTER INSERT OR UPDATE OF set_temp, over_duration, temp_change ON temp_setting
+    FOR EACH ROW EXECUTE PROCEDURE notify_temp_setting_changed()
+'''
+
+LATEST_SETTINGS_SQL = "SELECT set_temp, over_duration, temp_change FROM temp_setting WHERE reactor_id = %s ORDER BY id DESC LIMIT 1"
+
+
+# Install the reactor columns and the notify trigger once per process start.
+# The advisory lock keeps concurrent starters from racing each other, and the
+# trigger is only created when missing, so temp_setting is not locked for a
+# DROP/CREATE every time.
+def install_settings_trigger(db_config):
+    conn = psycopg2.connect(**db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (NOTIFY_CHANNEL,))
+        ensure_reactor_columns(conn)
+        cursor.execute(TRIGGER_FUNCTION_SQL)
+        cursor.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'temp_setting_changed' AND tgrelid = 'temp_setting'::regclass"
+        )
+        if cursor.fetchone() is None:
+            cursor.execute(TRIGGER_SQL)
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Pushes one reactor's temperature settings to its controller through
+# PostgreSQL LISTEN/NOTIFY instead of polling temp_setting. The reactor's
+# latest row is read once on every (re)connect, so nothing is missed while
+# the connection was down, and again only when a notification for that
+# reactor arrives. on_change receives the (set_temp, over_duration,
+# temp_change) row. The trigger itself is installed by
+# install_settings_trigger; listeners only LISTEN.
+class SettingsListener:
+    def __init__(self, db_config, on_change, reactor_id):
+        self.db_config = db_config
+        self.on_change = on_change
+        self.reactor_id = reactor_id
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _fetch_latest(self, conn):
+        cursor = conn.cursor()
+        cursor.execute(LATEST_SETTINGS_SQL, (self.reactor_id,))
+        row = cursor.fetchone()
+        cursor.close()
+        if row:
+            self.on_change(row)
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.db_config)
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            cursor.close()
+            self._fetch_latest(conn)
+            while not self._stopped.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                # Several inserts in a row only need one read
+                changed = any(notify.payload == self.reactor_id for notify in conn.notifies)
+                conn.notifies.clear()
+                if changed:
+                    self._fetch_latest(conn)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                print(f"Error listening for settings changes: {e}")
+                self._stopped.wait(RECONNECT_DELAY)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='settings-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
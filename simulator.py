@@ -0,0 +1,225 @@
+import argparse
+import heapq
+import itertools
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import psycopg2
+from dotenv import load_dotenv
+
+from control_engine import ControlEngine
+from control_rules import load_reactor_configs, reactor_config
+from topics import CONTROL_TOPICS, DEFAULT_REACTOR, TOPICS
+
+
+# In-process stand-in for the MQTT broker. The control engine publishes to
+# it like a paho client; every publish is recorded with the simulated time
+# and delivered to local subscribers such as the plant model.
+class LocalBroker:
+    def __init__(self, clock):
+        self.clock = clock
+        self.published = []
+        self._subscribers = {}
+
+    def subscribe(self, topic, callback):
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((self.clock(), topic, payload))
+        for callback in self._subscribers.get(topic, ()):
+            callback(topic, payload)
+
+
+# Simple first-order model of one CSTR / membrane tank pair, good enough to
+# close the loop around the controller without hardware
+class PlantModel:
+    def __init__(self, broker, relay_topics, ambient=25.0, cstr_temp=25.0, cstr_level=22.0, mtank_temp=25.0, mtank_level=7900.0):
+        self.ambient = ambient
+        self.values = {
+            "cstr-temp": cstr_temp,
+            "cstr-level": cstr_level,
+            "mtank-temp": mtank_temp,
+            "mtank-level": mtank_level,
+        }
+        self.relays = {}
+        # Relays are tracked under their plain names whatever the reactor
+        for relay, topic in relay_topics.items():
+            broker.subscribe(topic, lambda _, payload, relay=relay: self.relays.__setitem__(relay, payload))
+
+    def _on(self, relay):
+        return self.relays.get(relay) in ("on", "Yes")
+
+    # Advance the plant by dt seconds
+    def step(self, dt):
+        v = self.values
+        heaters = self._on("cstr/heater1") + self._on("cstr/heater2")
+        v["cstr-temp"] += dt * (heaters * 0.0015 - 0.0002 * (v["cstr-temp"] - self.ambient))
+        v["mtank-temp"] += dt * (0.0004 * (v["cstr-temp"] - v["mtank-temp"]) - 0.0003 * (v["mtank-temp"] - self.ambient))
+        v["cstr-level"] += dt * ((0.002 if self._on("cstr/in") else 0) - 0.001)
+        v["mtank-level"] += dt * ((0.8 if self._on("mtank/in") else 0) - (1.5 if self._on("mtank/out") else 0) - 0.3)
+        v["cstr-level"] = min(max(v["cstr-level"], 0.0), 30.0)
+        v["mtank-level"] = max(v["mtank-level"], 0.0)
+        return dict(v)
+
+
+# Drives a ControlEngine synchronously on simulated time, so months of data
+# run through the control logic in minutes. Ramp steps, and heater ticks in
+# PID mode, are generated the way the scheduler would.
+class Simulator:
+    def __init__(self, config=None, reactor_id=DEFAULT_REACTOR):
+        self.now = None
+        self.broker = LocalBroker(lambda: self.now)
+        self.config = reactor_config(config)
+        self.engine = ControlEngine(self.broker, self.config, on_ramp_reset=self._reset_ramp, reactor_id=reactor_id,
+                                    clock=lambda: self.now.timestamp())
+        self.next_ramp = None
+        self.next_heater_tick = None
+        self.events = 0
+
+    def _reset_ramp(self):
+        self.next_ramp = self.now + timedelta(seconds=self.config["ramp_interval"])
+
+    def _handle(self, event):
+        self.engine.handle(event)
+        self.events += 1
+
+    def _advance(self, timestamp):
+        tick = self.engine.heater_tick_interval
+        if tick is not None and self.next_heater_tick is None:
+            self.next_heater_tick = timestamp
+        while True:
+            due = [t for t in (self.next_ramp, self.next_heater_tick) if t is not None and t <= timestamp]
+            if not due:
+                break
+            self.now = min(due)
+            if self.now == self.next_ramp:
+                self.next_ramp += timedelta(seconds=self.config["ramp_interval"])
+                self._handle(("ramp", None))
+            else:
+                self.next_heater_tick += timedelta(seconds=tick)
+                self._handle(("heater_tick", None))
+        self.now = timestamp
+
+    # Feed (timestamp, event) pairs in time order
+    def run(self, timed_events):
+        started = time.perf_counter()
+        for timestamp, event in timed_events:
+            self._advance(timestamp)
+            self._handle(event)
+        return self.report(time.perf_counter() - started)
+
+    # Close the loop around the plant model for duration seconds, sampling
+    # every sensor each step seconds
+    def run_model(self, start, duration, settings, plant=None, step=5):
+        plant = plant or PlantModel(self.broker, self.engine.relay_topics)
+
+        def timed_events():
+            yield start, ("settings", settings)
+            for i in range(int(duration // step)):
+                timestamp = start + timedelta(seconds=i * step)
+                for topic, value in plant.step(step).items():
+                    yield timestamp, ("sensor", topic, value)
+        return self.run(timed_events())
+
+    def report(self, elapsed):
+        actions = list(self.broker.published)
+        switches = Counter(topic for _, topic, _ in actions)
+        return {
+            "events": self.events,
+            "evaluations": self.engine.evaluations,
+            "wall_seconds": elapsed,
+            "evaluations_per_second": self.engine.evaluations / elapsed if elapsed else 0.0,
+            "relay_switches": dict(switches),
+            "heater": self.engine.heater_metrics(),
+            "actions": actions,
+        }
+
+
+# Historical sensor readings and settings of one reactor as (timestamp,
+# event) pairs in time order
+def replay_events(conn, reactor_id, start, end):
+    columns = [TOPICS[topic].column for topic in CONTROL_TOPICS]
+    cursor = conn.cursor(name="simulator_replay")
+    cursor.itersize = 5000
+    cursor.execute(
+        f"SELECT timestamp, {', '.join(columns)} FROM sensor_data "
+        "WHERE reactor_id = %s AND timestamp BETWEEN %s AND %s ORDER BY timestamp",
+        (reactor_id, start, end)
+    )
+
+    def sensor_events():
+        for row in cursor:
+            for topic, value in zip(CONTROL_TOPICS, row[1:]):
+                if value is not None:
+                    yield row[0], ("sensor", topic, value)
+
+    settings_cursor = conn.cursor()
+    settings_cursor.execute(
+        "SELECT timestamp, set_temp, over_duration, temp_change FROM temp_setting "
+        "WHERE reactor_id = %s AND timestamp <= %s ORDER BY timestamp",
+        (reactor_id, end)
+    )
+    settings_events = []
+    for row in settings_cursor.fetchall():
+        # Settings in force before the replay starts apply from its start
+        settings_events.append((max(row[0], start), ("settings", row[1:])))
+    settings_cursor.close()
+
+    # Merge on timestamp, settings first when they coincide
+    counter = itertools.count()
+    return (
+        (timestamp, event) for timestamp, _, _, event in heapq.merge(
+            ((t, 0, next(counter), e) for t, e in settings_events),
+            ((t, 1, next(counter), e) for t, e in sensor_events()),
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay sensor history or a plant model through the control logic")
+    parser.add_argument("--reactor", default=DEFAULT_REACTOR)
+    parser.add_argument("--config", help="reactors.json with per-reactor control settings")
+    parser.add_argument("--from", dest="start", help="Replay start, YYYY-MM-DD HH:MM")
+    parser.add_argument("--to", dest="end", help="Replay end, YYYY-MM-DD HH:MM")
+    parser.add_argument("--model-hours", type=float, help="Run the plant model for this many hours instead of replaying")
+    parser.add_argument("--heater-mode", choices=("bands", "pid"), help="Override the reactor's heater_mode")
+    parser.add_argument("--set-temp", type=float, default=35.0)
+    parser.add_argument("--temp-change", type=float, default=1.0)
+    args = parser.parse_args()
+    if not args.model_hours:
+        if not (args.start and args.end):
+            parser.error("--from and --to are required unless --model-hours is given")
+        try:
+            start = datetime.strptime(args.start, "%Y-%m-%d %H:%M")
+            end = datetime.strptime(args.end, "%Y-%m-%d %H:%M")
+        except ValueError as e:
+            parser.error(f"--from/--to: {e}")
+
+    config = load_reactor_configs(args.config)[args.reactor] if args.config else reactor_config()
+    if args.heater_mode:
+        config["heater_mode"] = args.heater_mode
+    simulator = Simulator(config, args.reactor)
+    if args.model_hours:
+        settings = (args.set_temp, None, args.temp_change)
+        result = simulator.run_model(datetime.now(), args.model_hours * 3600, settings)
+    else:
+        load_dotenv()
+        conn = psycopg2.connect(dbname="sensordata", user="postgres", password=os.environ.get("DB_PASSWORD"), host="localhost")
+        try:
+            result = simulator.run(replay_events(conn, args.reactor, start, end))
+        finally:
+            conn.close()
+
+    print(f"Events: {result['events']}, control evaluations: {result['evaluations']}")
+    print(f"Wall time: {result['wall_seconds']:.2f} s ({result['evaluations_per_second']:.0f} evaluations/s)")
+    for topic, count in sorted(result["relay_switches"].items()):
+        print(f"{topic}: {count} publishes")
+    heater = result["heater"]
+    print(f"Heater mode {heater['heater_mode']}: mean |error| {heater['mean_abs_temp_error']:.2f}, "
+          f"RMS error {heater['rms_temp_error']:.2f}, max |error| {heater['max_abs_temp_error']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
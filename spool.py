@@ -0,0 +1,134 @@
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+NAN = float('nan')
+
+# Suffix of the file that holds spooled rows the database refused
+REJECTED_SUFFIX = '.bad'
+
+
+# Append-only on-disk spool for rows that could not be written to the
+# database. Each row is stored as a fixed-size binary record (timestamps as
+# epoch seconds, numbers as doubles with NaN for NULL, flags as bytes, text
+# columns listed in codes as a 16-bit index into their known values)
+# followed by a CRC32, so a record torn by a power cut is detected and
+# skipped on replay. Every append is written and fsynced as one batch, after
+# cutting off any partial record a torn write left at the end of the file so
+# later records stay aligned.
+class Spool:
+    _FORMATS = {'time': 'd', 'number': 'd', 'flag': '?', 'code': 'H'}
+
+    def __init__(self, path, columns, codes=None):
+        self.path = path
+        self.columns = tuple(columns)
+        self.codes = {column: tuple(values) for column, values in (codes or {}).items()}
+        self._code_index = {column: {value: i for i, value in enumerate(values)} for column, values in self.codes.items()}
+        self._kinds = tuple('code' if column in self.codes else self._kind(column) for column in self.columns)
+        self._body = struct.Struct('<' + ''.join(self._FORMATS[kind] for kind in self._kinds))
+        self._record_size = self._body.size + 4
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _kind(column):
+        if column == 'timestamp':
+            return 'time'
+        if column == 'published':
+            return 'flag'
+        return 'number'
+
+    def _encode(self, row):
+        values = []
+        for column, kind, value in zip(self.columns, self._kinds, row):
+            if kind == 'code':
+                values.append(self._code_index[column][value])
+            elif kind == 'flag':
+                values.append(bool(value))
+            elif value is None:
+                values.append(NAN)
+            elif kind == 'time':
+                values.append(value.timestamp())
+            else:
+                values.append(float(value))
+        body = self._body.pack(*values)
+        return body + struct.pack('<I', zlib.crc32(body))
+
+    def _decode(self, record):
+        body, (crc,) = record[:-4], struct.unpack('<I', record[-4:])
+        if zlib.crc32(body) != crc:
+            return None
+        row = []
+        for column, kind, value in zip(self.columns, self._kinds, self._body.unpack(body)):
+            if kind == 'code':
+                row.append(self.codes[column][value])
+            elif kind == 'flag':
+                row.append(value)
+            elif value != value:  # NaN marks NULL
+                row.append(None)
+            elif kind == 'time':
+                row.append(datetime.fromtimestamp(value))
+            else:
+                row.append(value)
+        return tuple(row)
+
+    def _write(self, path, rows):
+        data = b''.join(self._encode(row) for row in rows)
+        with self._lock:
+            with open(path, 'ab') as f:
+                torn = f.seek(0, os.SEEK_END) % self._record_size
+                if torn:
+                    print(f"Truncating {torn} bytes of a torn record from spool.")
+                    f.truncate(f.tell() - torn)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def append(self, rows):
+        self._write(self.path, rows)
+
+    # Keep rows the database refused in a file next to the spool, in the same
+    # format, so they can be inspected without blocking the rest of the replay
+    def reject(self, rows):
+        self._write(self.path + REJECTED_SUFFIX, rows)
+
+    # Number of complete records waiting to be replayed
+    def pending(self):
+        try:
+            return os.path.getsize(self.path) // self._record_size
+        except FileNotFoundError:
+            return 0
+
+    # Yield the spooled rows in lists of at most chunk_size, skipping records
+    # that fail their checksum
+    def read_chunks(self, chunk_size):
+        with self._lock:
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                return
+        with f:
+            chunk = []
+            while True:
+                record = f.read(self._record_size)
+                if len(record) < self._record_size:
+                    break
+                row = self._decode(record)
+                if row is None:
+                    print("Skipping corrupt record in spool.")
+                    continue
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    # Discard the spool once its rows are safely in the database
+    def clear(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,115 @@
+import time
+
+from db_pool import DB_QUERY_SECONDS
+from metrics import REGISTRY
+
+# Rows fetched and uploaded per Supabase insert
+SYNC_CHUNK_SIZE = 500
+
+# Seconds backlog() waits for a database connection, so a metrics scrape
+# gives up quickly instead of queueing behind the writers
+BACKLOG_CHECKOUT_TIMEOUT = 2
+
+SYNC_ROWS = REGISTRY.counter('sync_rows_total', 'Rows uploaded to Supabase', ('table',))
+SYNC_UPLOAD_SECONDS = REGISTRY.histogram('sync_upload_seconds', 'Supabase insert latency per chunk in seconds', ('table',))
+SYNC_ROWS_PER_SECOND = REGISTRY.gauge('sync_rows_per_second', 'Upload throughput of the last sync that sent rows', ('table',))
+
+
+# Streams the unpublished rows of one local table to Supabase in id order,
+# one fixed-size chunk at a time. After every uploaded chunk the rows are
+# marked published and the highest id sent is stored in the sync_watermark
+# table in one transaction, so an interrupted sync resumes after the last
+# confirmed chunk instead of starting over. format_row receives each row as
+# a dict of the id plus the listed columns.
+class SyncEngine:
+    def __init__(self, db_pool, table, columns, format_row, upload, chunk_size=SYNC_CHUNK_SIZE):
+        self.db_pool = db_pool
+        self.table = table
+        self.columns = ('id',) + tuple(columns)
+        self.format_row = format_row
+        self.upload = upload
+        self.chunk_size = chunk_size
+
+    def _ensure_watermark_table(self, cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_watermark (
+            table_name TEXT PRIMARY KEY,
+            last_id BIGINT NOT NULL
+        )
+        ''')
+
+    def _load_watermark(self, cursor):
+        cursor.execute("SELECT last_id FROM sync_watermark WHERE table_name = %s", (self.table,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _save_watermark(self, cursor, last_id):
+        cursor.execute('''
+        INSERT INTO sync_watermark (table_name, last_id) VALUES (%s, %s)
+        ON CONFLICT (table_name) DO UPDATE SET last_id = EXCLUDED.last_id
+        ''', (self.table, last_id))
+
+    # Rows past the watermark, i.e. still to be uploaded. Ids only grow, so
+    # this is a primary key lookup rather than a count of unpublished rows.
+    def backlog(self):
+        with self.db_pool.connection(timeout=BACKLOG_CHECKOUT_TIMEOUT) as conn:
+            cursor = conn.cursor()
+            self._ensure_watermark_table(cursor)
+            last_id = self._load_watermark(cursor)
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {self.table}")
+            newest_id = cursor.fetchone()[0]
+            cursor.close()
+        return max(newest_id - last_id, 0)
+
+    # Mark a whole chunk as published by id range. The chunk holds every
+    # unpublished row between the two ids, so the statement stays the same
+    # size however many rows were sent.
+    def _mark_published(self, cursor, after_id, last_id):
+        cursor.execute(
+            f"UPDATE {self.table} SET published = TRUE WHERE id > %s AND id <= %s AND published = FALSE",
+            (after_id, last_id)
+        )
+
+    # Upload everything past the watermark and return the number of rows
+    # sent. Raises at the first chunk Supabase does not accept; the chunks
+    # before it stay committed.
+    def run(self):
+        sent = 0
+        started = time.monotonic()
+        with self.db_pool.connection() as conn:
+            cursor = conn.cursor()
+            self._ensure_watermark_table(cursor)
+            last_id = self._load_watermark(cursor)
+            cursor.close()
+
+        # One keyset query per chunk rather than one cursor over the whole
+        # backlog, so nothing is materialised on the server and no connection
+        # is held while Supabase is being waited on
+        query = f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE published = FALSE AND id > %s ORDER BY id LIMIT %s"
+        while True:
+            with self.db_pool.connection() as conn:
+                cursor = conn.cursor()
+                with DB_QUERY_SECONDS.time('sync_fetch'):
+                    cursor.execute(query, (last_id, self.chunk_size))
+                    rows = cursor.fetchall()
+                cursor.close()
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            with SYNC_UPLOAD_SECONDS.time(self.table):
+                response = self.upload([self.format_row(dict(zip(self.columns, row))) for row in rows])
+            if not (response and response.data):
+                raise RuntimeError(f"Supabase did not accept {self.table} rows after id {last_id}")
+            with DB_QUERY_SECONDS.time('sync_mark_published'):
+                with self.db_pool.connection() as conn:
+                    cursor = conn.cursor()
+                    self._mark_published(cursor, last_id, ids[-1])
+                    self._save_watermark(cursor, ids[-1])
+                    cursor.close()
+            SYNC_ROWS.inc(self.table, amount=len(rows))
+            sent += len(rows)
+            last_id = ids[-1]
+        if sent:
+            SYNC_ROWS_PER_SECOND.set(sent / max(time.monotonic() - started, 1e-6), self.table)
+            print(f"Uploaded {sent} {self.table} rows to Supabase.")
+        return sent
@@ -0,0 +1,71 @@
+import queue
+import threading
+import time
+
+# Pending sync requests; anything beyond this is coalesced into the queued one
+SYNC_QUEUE_SIZE = 1
+
+# Retry delays after a failed sync, doubling up to the maximum
+SYNC_BACKOFF_INITIAL = 5
+SYNC_BACKOFF_MAX = 600
+
+
+# Runs the cloud sync on its own thread so the sampling loop never waits on
+# the network. Requests go through a bounded queue: when a sync is already
+# pending, further requests are coalesced instead of piling up. Failed syncs
+# are retried with exponential backoff.
+class SyncWorker:
+    def __init__(self, sync, is_online, queue_size=SYNC_QUEUE_SIZE,
+                 backoff_initial=SYNC_BACKOFF_INITIAL, backoff_max=SYNC_BACKOFF_MAX):
+        self.sync = sync
+        self.is_online = is_online
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self._requests = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._thread = None
+        self.backoff = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    # Ask for a sync without blocking; returns False if one is already queued
+    def request(self):
+        try:
+            self._requests.put_nowait(time.monotonic())
+            return True
+        except queue.Full:
+            self.coalesced += 1
+            return False
+
+    def _fail(self):
+        self.failures += 1
+        self.backoff = min(self.backoff * 2, self.backoff_max) if self.backoff else self.backoff_initial
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._requests.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self.backoff and self._stopped.wait(self.backoff):
+                break
+            try:
+                if not self.is_online():
+                    self._fail()
+                    continue
+                if self.sync():
+                    self.backoff = 0
+                else:
+                    self._fail()
+            except Exception as e:
+                print(f"Error in sync worker: {e}")
+                self._fail()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sync-worker', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
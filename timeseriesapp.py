@@ -4,10 +4,15 @@ import tkinter as tk
 from tkcalendar import DateEntry
 from tkinter import Canvas, Scrollbar
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import numpy as np
 import pandas as pd
 import psycopg2
 from datetime import datetime, timedelta
+from topics import REACTORS, DEFAULT_REACTOR
+from downsample import downsample
+from history import fetch_history
 
 # Initialize the main application
 app = ctk.CTk()
@@ -16,6 +21,9 @@ app.geometry('1920x1080')
 
 # Database connection
 conn = psycopg2.connect(dbname="sensordata", user="postgres", password="399584")
+# Read-only use: without autocommit the first query would open a transaction
+# that holds its table locks for as long as the app runs
+conn.autocommit = True
 cur = conn.cursor()
 
 # Create a transparent frame for the top title bar
@@ -161,67 +169,162 @@ parameters = ['cstr_ph', 'cstr_temp', 'cstr_level', 'cstr_orp', 'cstr_ec', 'cstr
 for param in parameters:
     menu_bar.add_command(label=param.replace('_', ' ').title(), command=lambda p=param: display_graph(p))
 
-# Function to fetch data from the database
-def fetch_data(param, from_datetime, to_datetime):
-    query = f"SELECT timestamp, {param} FROM sensor_data WHERE timestamp BETWEEN '{from_datetime}' AND '{to_datetime}' ORDER BY timestamp ASC"
-    cur.execute(query)
-    data = cur.fetchall()
-    if data:
-        df = pd.DataFrame(data, columns=['timestamp', param])
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        return df
+# Reactor whose data the graphs show
+selected_reactor = DEFAULT_REACTOR
+
+# Function to switch the graphs to another reactor
+def select_reactor():
+    global selected_reactor
+    selected_reactor = reactor_var.get()
+    update_graphs()
+
+reactor_var = tk.StringVar(value=selected_reactor)
+reactor_menu = tk.Menu(menu_bar, tearoff=0)
+for reactor_id in REACTORS:
+    reactor_menu.add_radiobutton(label=reactor_id, variable=reactor_var, value=reactor_id, command=select_reactor)
+menu_bar.add_cascade(label="Reactor", menu=reactor_menu)
+
+# Span of data shown on the "View All" graphs
+DASHBOARD_WINDOW = timedelta(days=1)
+
+# Every parameter of the selected reactor over DASHBOARD_WINDOW, shared by
+# all the "View All" graphs. After the first load only rows with an id past
+# last_id (and still inside the window) are fetched, which also picks up
+# readings replayed late with older timestamps. version changes whenever data
+# does.
+dashboard_cache = {
+    'reactor': None,
+    'last_id': None,
+    'version': 0,
+    'data': pd.DataFrame(columns=['timestamp'] + parameters)
+}
+
+# Function to bring the dashboard cache up to date with one query
+def refresh_dashboard_data():
+    window_start = datetime.now() - DASHBOARD_WINDOW
+    columns = ', '.join(parameters)
+    if dashboard_cache['reactor'] != selected_reactor or dashboard_cache['last_id'] is None:
+        query = f"SELECT id, timestamp, {columns} FROM sensor_data WHERE reactor_id = %s AND timestamp >= %s ORDER BY id ASC"
+        cur.execute(query, (selected_reactor, window_start))
+        rows = cur.fetchall()
+        dashboard_cache['reactor'] = selected_reactor
+        dashboard_cache['version'] += 1
+        dashboard_cache['data'] = pd.DataFrame(columns=['timestamp'] + parameters)
+        if not rows:
+            # Nothing in the window yet: start after the newest row
+            # so later refreshes do not scan its whole history
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM sensor_data")
+            dashboard_cache['last_id'] = cur.fetchone()[0]
     else:
-        return pd.DataFrame(columns=['timestamp', param])
+        query = f"SELECT id, timestamp, {columns} FROM sensor_data WHERE reactor_id = %s AND id > %s AND timestamp >= %s ORDER BY id ASC"
+        cur.execute(query, (selected_reactor, dashboard_cache['last_id'], window_start))
+        rows = cur.fetchall()
+
+    data = dashboard_cache['data']
+    if rows:
+        dashboard_cache['last_id'] = rows[-1][0]
+        dashboard_cache['version'] += 1
+        new_data = pd.DataFrame([row[1:] for row in rows], columns=['timestamp'] + parameters)
+        new_data['timestamp'] = pd.to_datetime(new_data['timestamp'])
+        new_data = new_data.astype({param: float for param in parameters})
+        out_of_order = not data.empty and new_data['timestamp'].iloc[0] < data['timestamp'].iloc[-1]
+        data = new_data if data.empty else pd.concat([data, new_data], ignore_index=True)
+        if out_of_order or not new_data['timestamp'].is_monotonic_increasing:
+            data = data.sort_values('timestamp', kind='stable', ignore_index=True)
+    # Drop what has scrolled out of the window
+    if not data.empty and data['timestamp'].iloc[0] < window_start:
+        data = data[data['timestamp'] >= window_start].reset_index(drop=True)
+        dashboard_cache['version'] += 1
+    dashboard_cache['data'] = data
+    return data
+
+# Fraction of DASHBOARD_WINDOW the time axis runs ahead of the newest
+# reading, and of the value range added above and below it, so the axes only
+# need rescaling every so often rather than on every refresh
+AXIS_MARGIN = 0.05
+
+# Multi-graphs: title and the two parameters plotted together
+multi_graphs = [
+    ('ORP and EC', 'cstr_orp', 'cstr_ec'),
+    ('ORP and PH', 'cstr_orp', 'cstr_ph'),
+    ('EC and PH', 'cstr_ec', 'cstr_ph')
+]
+
+# Dashboard cache version and reactor the graphs were last drawn from
+drawn = {'version': None, 'reactor': None}
+
+# Function to create a graph with one persistent line per column. Title,
+# labels and legend are set here once and never redrawn from scratch.
+def create_graph(key, master, title, ylabel, columns):
+    fig, ax = plt.subplots(figsize=(6, 4))
+    lines = {column: ax.plot([], [], marker='o', linestyle='-', label=column)[0] for column in columns}
+    ax.xaxis_date()
+    ax.set_title(title, fontsize=16, fontname='Helvetica', fontweight='bold')
+    ax.set_xlabel('Time')
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    graph_widgets[key] = (fig, ax, FigureCanvasTkAgg(fig, master=master), lines)
+    return graph_widgets[key]
+
+# Function to refit a graph's axes when the data leaves them or has shrunk
+# to a small part of them, or whenever force is set
+def rescale_graph(ax, times, values, force):
+    if len(times) == 0:
+        return
+    left, right = ax.get_xlim()
+    if force or times[0] < left or times[-1] > right:
+        span = max(times[-1] - times[0], DASHBOARD_WINDOW / timedelta(days=1))
+        ax.set_xlim(times[0], times[-1] + span * AXIS_MARGIN)
+    finite = values[~pd.isna(values)]
+    if len(finite) == 0:
+        return
+    low, high = finite.min(), finite.max()
+    bottom, top = ax.get_ylim()
+    if force or low < bottom or high > top or (high - low) < (top - bottom) * AXIS_MARGIN * 5:
+        pad = (high - low) * AXIS_MARGIN or abs(high) * AXIS_MARGIN or 1
+        ax.set_ylim(low - pad, high + pad)
+
+# Function to point a graph's lines at the latest data, reduced to what the
+# plot width can show, and redraw it when Tk is next idle
+def update_graph(key, data, force):
+    fig, ax, canvas, lines = graph_widgets[key]
+    times = mdates.date2num(data['timestamp'])
+    width = canvas.get_tk_widget().winfo_width()
+    values = []
+    for column, line in lines.items():
+        line_times, line_values = downsample(times, data[column].to_numpy(dtype=float), width)
+        line.set_data(line_times, line_values)
+        values.append(line_values)
+    rescale_graph(ax, times, np.concatenate(values), force)
+    canvas.draw_idle()
 
 # Function to update the graphs with data from the database
 def update_graphs():
-    now = datetime.now()
-    one_day_ago = now - timedelta(days=1)
-    from_datetime = one_day_ago.strftime('%Y-%m-%d %H:%M:%S')
-    to_datetime = now.strftime('%Y-%m-%d %H:%M:%S')
+    data = refresh_dashboard_data()
+    if drawn['version'] == dashboard_cache['version']:
+        return
+    # Fit the axes afresh after switching reactors
+    force = drawn['reactor'] != selected_reactor
+    drawn['version'] = dashboard_cache['version']
+    drawn['reactor'] = selected_reactor
 
     for param in parameters:
-        data = fetch_data(param, from_datetime, to_datetime)
-        if not data.empty:
-            if param not in graph_widgets:
-                fig, ax = plt.subplots(figsize=(6, 4))
-                graph_widgets[param] = (fig, ax, FigureCanvasTkAgg(fig, master=param_frames[param]))
-                graph_widgets[param][2].get_tk_widget().pack(fill=tk.BOTH, expand=1)
-
-            ax = graph_widgets[param][1]
-            ax.clear()
-            ax.plot(data['timestamp'], data[param], marker='o', linestyle='-', label=param)
-            ax.set_title(param.replace("_", " ").title(), fontsize=16, fontname='Helvetica', fontweight='bold')
-            ax.set_xlabel('Time')
-            ax.set_ylabel(param)
-            ax.legend()
-            graph_widgets[param][2].draw()
-
-    # Multi-graphs
-    multi_graphs = [
-        ('ORP and EC', 'cstr_orp', 'cstr_ec'),
-        ('ORP and PH', 'cstr_orp', 'cstr_ph'),
-        ('EC and PH', 'cstr_ec', 'cstr_ph')
-    ]
+        created = param not in graph_widgets
+        if created:
+            if data.empty:
+                continue
+            create_graph(param, param_frames[param], param.replace("_", " ").title(), param, [param])
+            graph_widgets[param][2].get_tk_widget().pack(fill=tk.BOTH, expand=1)
+        update_graph(param, data, force or created)
+
     for i, (title, col1, col2) in enumerate(multi_graphs):
-        data_col1 = fetch_data(col1, from_datetime, to_datetime)
-        data_col2 = fetch_data(col2, from_datetime, to_datetime)
-        
-        if not data_col1.empty and not data_col2.empty:
-            if title not in graph_widgets:
-                fig, ax = plt.subplots(figsize=(6, 4))
-                graph_widgets[title] = (fig, ax, FigureCanvasTkAgg(fig, master=scrollable_frame))
-                graph_widgets[title][2].get_tk_widget().grid(row=(i + 12) // 3, column=(i + 12) % 3, padx=10, pady=10, sticky='nsew')
-
-            ax = graph_widgets[title][1]
-            ax.clear()
-            ax.plot(data_col1['timestamp'], data_col1[col1], marker='o', linestyle='-', label=col1)
-            ax.plot(data_col2['timestamp'], data_col2[col2], marker='o', linestyle='-', label=col2)
-            ax.set_title(title, fontsize=16, fontname='Helvetica', fontweight='bold')
-            ax.set_xlabel('Time')
-            ax.set_ylabel('Values')
-            ax.legend()
-            graph_widgets[title][2].draw()
+        created = title not in graph_widgets
+        if created:
+            if data.empty:
+                continue
+            create_graph(title, scrollable_frame, title, 'Values', [col1, col2])
+            graph_widgets[title][2].get_tk_widget().grid(row=(i + 12) // 3, column=(i + 12) % 3, padx=10, pady=10, sticky='nsew')
+        update_graph(title, data, force or created)
 
     scrollable_frame.update_idletasks()
 
@@ -239,11 +342,15 @@ def fetch_and_display(param, from_date_input, from_time_input, to_date_input, to
 
 # Function to fetch and display time series from the database
 def fetch_and_display_timeseries(param, from_datetime, to_datetime, canvas, figure, timeseries_window):
-    data = fetch_data(param, from_datetime, to_datetime)
+    # One bucket per pixel of the canvas, averaged in the database
+    data, bucket = fetch_history(cur, selected_reactor, [param], from_datetime, to_datetime, canvas.get_tk_widget().winfo_width())
     if not data.empty:
+        times = mdates.date2num(data['timestamp'])
+        figure.clear()
         ax = figure.add_subplot(111)
-        ax.clear()
-        ax.plot(data['timestamp'], data[param], marker='o', linestyle='-', label=param)
+        ax.xaxis_date()
+        ax.fill_between(times, data[f'{param}_min'], data[f'{param}_max'], alpha=0.3, linewidth=0)
+        ax.plot(times, data[param], linestyle='-', label=f'{param} ({bucket} avg)')
         ax.set_title(param.replace("_", " ").title(), fontsize=16, fontname='Helvetica', fontweight='bold')
         ax.set_xlabel('Time')
         ax.set_ylabel(param)
@@ -261,7 +368,7 @@ def periodic_update():
     update_graphs()
     app.after(5000, periodic_update)
 
-# Store the FigureCanvasTkAgg objects to avoid redrawing
+# Figure, axes, canvas and lines of each "View All" graph, kept between refreshes
 graph_widgets = {}
 
 # Create a dictionary of parameter frames
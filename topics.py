@@ -0,0 +1,89 @@
+import json
+from collections import namedtuple
+
+# One entry per MQTT topic published by the reactor:
+#   column       sensor_data column the reading belongs to
+#   decode       payload -> value, raising ValueError for bad or out of range data
+#   unit, label  how the dashboards display it
+#   valid_range  (min, max) accepted by decode, None for no limit
+#   stored       whether data_control records it in sensor_data
+Topic = namedtuple('Topic', ['name', 'column', 'decode', 'unit', 'label', 'valid_range', 'stored'])
+
+
+def _parse_float(payload):
+    try:
+        return float(payload)
+    except (TypeError, ValueError):
+        # Payloads published as JSON strings, e.g. "\"23.5\""
+        try:
+            return float(json.loads(payload))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid numeric payload {payload!r}") from e
+
+
+def _parse_text(payload):
+    return payload.decode() if isinstance(payload, (bytes, bytearray)) else str(payload)
+
+
+# Build the decoder for a topic once, with its range check folded in
+def _float_decoder(valid_range):
+    if valid_range is None:
+        return _parse_float
+    low, high = valid_range
+
+    def decode(payload):
+        value = _parse_float(payload)
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise ValueError(f"Reading {value} outside valid range {valid_range}")
+        return value
+    return decode
+
+
+def _topic(name, column, unit, label, valid_range=None, stored=True, text=False):
+    decode = _parse_text if text else _float_decoder(valid_range)
+    return Topic(name, column, decode, unit, label, valid_range, stored)
+
+
+TOPICS = {topic.name: topic for topic in (
+    _topic('cstr-ph', 'cstr_ph', '/14', 'PH', (0, 14)),
+    _topic('cstr-tds', 'cstr_tds', 'PPM', 'TDS', (0, None)),
+    _topic('cstr-orp', 'cstr_orp', 'mV', 'ORP'),
+    _topic('cstr-temp', 'cstr_temp', '°C', 'Temp', (-20, 150)),
+    _topic('cstr-ec', 'cstr_ec', 'mS/cm', 'EC', (0, None)),
+    _topic('cstr-level', 'cstr_level', 'Liters', 'Level'),
+    _topic('mtank-temp', 'mtank_temp', '°C', 'Temp', (-20, 150)),
+    _topic('mtank-level', 'mtank_level', 'mL', 'Level'),
+    _topic('mtank-recycle', 'mtank_recycle', '', 'Recycle', stored=False, text=True),
+    _topic('effluent-temp', 'effluent_temp', '°C', 'Temp', (-20, 150), stored=False),
+    _topic('effluent-level', 'effluent_level', 'mL', 'Level'),
+    _topic('weight', 'weight', 'g', 'Weight'),
+    _topic('flux', 'flux', 'mL/min', 'Flux', stored=False),
+)}
+
+# Topics recorded in sensor_data by data_control
+SENSOR_TOPICS = {name: topic for name, topic in TOPICS.items() if topic.stored}
+
+# Topics the reactor controller acts on
+CONTROL_TOPICS = ('cstr-temp', 'cstr-level', 'mtank-temp', 'mtank-level')
+
+# Reactors served by this installation, mapped to the prefix of their MQTT
+# topics. The first reactor keeps the original un-prefixed topic names, so
+# existing sensors and relays keep working unchanged.
+REACTORS = {
+    'reactor1': '',
+}
+DEFAULT_REACTOR = next(iter(REACTORS))
+
+
+# Full MQTT topic of a reactor's sensor, relay or settings topic
+def reactor_topic(reactor_id, name):
+    prefix = REACTORS[reactor_id]
+    return f"{prefix}/{name}" if prefix else name
+
+
+# Full topic -> (reactor_id, Topic) for every reactor's registered topics
+ROUTES = {
+    reactor_topic(reactor_id, name): (reactor_id, topic)
+    for reactor_id in REACTORS
+    for name, topic in TOPICS.items()
+}